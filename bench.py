@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import re
+import gc
+import json
+import time
+import random
+import zlib
+import logging
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, List, Tuple, Union, Any
+import plac
+
+import pusher
+
+
+FIXTURES_DIR = Path(__file__).parent / 'bench' / 'fixtures'
+BASELINE = Path(__file__).parent / 'bench' / 'baseline.json'
+
+
+# glyphs as rendered by the widget at the leftmost position
+GLYPHS = {
+    '-': 'M6.66 14.13L1.24 14.13L1.24 12.35L6.66 12.35L6.66 14.13Z',
+    '0': 'M5.40 18.23L5.40 18.23Q3.13 18.23 1.93 16.56Q0.72 14.89 0.72 11.68L0.72 11.68Q0.72 8.48 1.92 6.80Q3.11 5.13 5.40 5.13L5.40 5.13Q7.69 5.13 8.88 6.80Q10.08 8.48 10.08 11.66L10.08 11.66Q10.08 14.89 8.87 16.56Q7.67 18.23 5.40 18.23ZM5.40 16.43L5.40 16.43Q6.64 16.43 7.22 15.29Q7.79 14.15 7.79 11.66L7.79 11.66Q7.79 9.20 7.22 8.08Q6.64 6.97 5.40 6.97L5.40 6.97Q4.16 6.97 3.58 8.09Q3.01 9.22 3.01 11.66L3.01 11.66Q3.01 14.15 3.58 15.29Q4.16 16.43 5.40 16.43Z',
+    '1': 'M7.13 17.03L4.81 17.03L4.81 6.98L5.98 7.24L2.21 9.50L2.21 7.43L5.78 5.27L7.13 5.27L7.13 17.03ZM9.94 18.09L2.02 18.09L2.02 16.22L9.94 16.22L9.94 18.09Z',
+    '2': 'M9.88 18.09L1.30 18.09L1.30 16.38L5.63 11.68Q6.39 10.84 6.75 10.13Q7.11 9.43 7.11 8.75L7.11 8.75Q7.11 7.87 6.61 7.42Q6.10 6.97 5.15 6.97L5.15 6.97Q4.28 6.97 3.41 7.30Q2.54 7.63 1.67 8.30L1.67 8.30L0.88 6.61Q1.66 5.92 2.84 5.53Q4.03 5.13 5.26 5.13L5.26 5.13Q6.52 5.13 7.45 5.54Q8.39 5.96 8.89 6.74Q9.40 7.52 9.40 8.60L9.40 8.60Q9.40 9.72 8.93 10.68Q8.46 11.65 7.34 12.85L7.34 12.85L3.44 16.99L3.17 16.22L9.88 16.22L9.88 18.09Z',
+    '3': 'M5.17 18.22L5.17 18.22Q3.87 18.22 2.67 17.83Q1.48 17.44 0.70 16.74L0.70 16.74L1.49 15.05Q2.34 15.71 3.23 16.05Q4.12 16.38 5.08 16.38L5.08 16.38Q6.32 16.38 6.91 15.90Q7.51 15.43 7.51 14.42L7.51 14.42Q7.51 13.45 6.89 12.98Q6.28 12.51 5.00 12.51L5.00 12.51L3.31 12.51L3.31 10.67L4.70 10.67Q5.94 10.67 6.56 10.21Q7.18 9.74 7.18 8.80L7.18 8.80Q7.18 7.90 6.64 7.43Q6.10 6.97 5.15 6.97L5.15 6.97Q4.27 6.97 3.38 7.30Q2.50 7.63 1.67 8.30L1.67 8.30L0.88 6.61Q1.66 5.92 2.84 5.53Q4.03 5.13 5.27 5.13L5.27 5.13Q6.53 5.13 7.46 5.54Q8.39 5.96 8.89 6.72Q9.40 7.49 9.40 8.51L9.40 8.51Q9.40 9.67 8.80 10.47Q8.21 11.27 7.13 11.59L7.13 11.59L7.11 11.41Q8.37 11.70 9.05 12.52Q9.72 13.34 9.72 14.62L9.72 14.62Q9.72 16.29 8.49 17.25Q7.25 18.22 5.17 18.22Z',
+    '4': 'M8.55 18.09L6.26 18.09L6.26 8.14L6.80 8.14L2.38 14.49L2.39 13.75L10.37 13.75L10.37 15.57L0.70 15.57L0.70 13.86L6.70 5.27L8.55 5.27L8.55 18.09Z',
+    '5': 'M5.40 18.22L5.40 18.22Q4.21 18.22 3.03 17.82Q1.85 17.42 1.10 16.74L1.10 16.74L1.87 15.05Q2.74 15.70 3.63 16.04Q4.52 16.38 5.44 16.38L5.44 16.38Q6.62 16.38 7.27 15.78Q7.92 15.17 7.92 14.06L7.92 14.06Q7.92 13.34 7.62 12.82Q7.33 12.29 6.79 12.01Q6.25 11.72 5.51 11.72L5.51 11.72Q4.77 11.72 4.10 12.00Q3.44 12.28 2.90 12.82L2.90 12.82L1.51 12.82L1.51 5.27L9.54 5.27L9.54 7.09L3.78 7.09L3.78 11.32L3.08 11.21Q3.62 10.57 4.37 10.22Q5.13 9.88 6.08 9.88L6.08 9.88Q7.29 9.88 8.20 10.40Q9.11 10.93 9.62 11.84Q10.13 12.76 10.13 13.99L10.13 13.99Q10.13 15.25 9.55 16.21Q8.96 17.17 7.91 17.69Q6.86 18.22 5.40 18.22Z',
+    '6': 'M5.81 18.23L5.81 18.23Q3.40 18.23 2.08 16.61Q0.76 14.98 0.76 11.92L0.76 11.92Q0.76 9.77 1.38 8.25Q2.00 6.73 3.18 5.93Q4.36 5.13 5.98 5.13L5.98 5.13Q7.13 5.13 8.22 5.51Q9.31 5.89 10.12 6.61L10.12 6.61L9.32 8.30Q8.44 7.60 7.62 7.28Q6.80 6.97 6.07 6.97L6.07 6.97Q4.61 6.97 3.83 8.24Q3.04 9.50 3.04 11.88L3.04 11.88L3.04 12.85L2.79 12.40Q2.95 11.63 3.44 11.06Q3.92 10.49 4.64 10.18Q5.35 9.86 6.19 9.86L6.19 9.86Q7.34 9.86 8.23 10.40Q9.11 10.93 9.61 11.85Q10.12 12.78 10.12 13.99L10.12 13.99Q10.12 15.23 9.56 16.19Q9.00 17.15 8.04 17.69Q7.07 18.23 5.81 18.23ZM5.71 16.40L5.71 16.40Q6.70 16.40 7.30 15.76Q7.90 15.12 7.90 14.06L7.90 14.06Q7.90 13.00 7.30 12.36Q6.70 11.72 5.69 11.72L5.69 11.72Q5.02 11.72 4.51 12.02Q4.00 12.31 3.71 12.84Q3.42 13.37 3.42 14.06L3.42 14.06Q3.42 14.76 3.71 15.28Q4.00 15.80 4.51 16.10Q5.02 16.40 5.71 16.40Z',
+    '7': 'M9.86 7.00L4.05 18.09L1.57 18.09L7.76 6.43L7.81 7.15L0.94 7.15L0.94 5.27L9.86 5.27L9.86 7.00Z',
+    '8': 'M5.40 18.22L5.40 18.22Q3.98 18.22 2.90 17.79Q1.82 17.37 1.22 16.56Q0.61 15.75 0.61 14.63L0.61 14.63Q0.61 13.28 1.49 12.43Q2.38 11.57 3.91 11.38L3.91 11.38L3.83 11.65Q2.48 11.38 1.69 10.56Q0.90 9.74 0.90 8.57L0.90 8.57Q0.90 7.51 1.49 6.73Q2.07 5.96 3.09 5.54Q4.10 5.13 5.40 5.13L5.40 5.13Q6.70 5.13 7.71 5.54Q8.73 5.96 9.32 6.73Q9.90 7.51 9.90 8.57L9.90 8.57Q9.90 9.76 9.11 10.58Q8.32 11.41 6.98 11.65L6.98 11.65L6.91 11.38Q8.44 11.59 9.32 12.46Q10.19 13.32 10.19 14.63L10.19 14.63Q10.19 15.75 9.59 16.56Q8.98 17.37 7.90 17.79Q6.82 18.22 5.40 18.22ZM5.40 16.42L5.40 16.42Q6.61 16.42 7.31 15.92Q8.01 15.43 8.01 14.47L8.01 14.47Q8.01 13.55 7.28 13.02Q6.55 12.49 5.40 12.35L5.40 12.35Q4.25 12.49 3.52 13.02Q2.79 13.55 2.79 14.47L2.79 14.47Q2.79 15.43 3.49 15.92Q4.19 16.42 5.40 16.42ZM5.40 10.87L5.40 10.87Q6.39 10.71 7.04 10.20Q7.69 9.68 7.69 8.80L7.69 8.80Q7.69 7.88 7.07 7.41Q6.44 6.93 5.40 6.93L5.40 6.93Q4.36 6.93 3.74 7.41Q3.11 7.88 3.11 8.80L3.11 8.80Q3.11 9.68 3.76 10.20Q4.41 10.71 5.40 10.87Z',
+    '9': 'M4.99 5.13L4.99 5.13Q7.42 5.13 8.73 6.76Q10.04 8.39 10.04 11.45L10.04 11.45Q10.04 13.59 9.42 15.11Q8.80 16.63 7.63 17.43Q6.46 18.23 4.82 18.23L4.82 18.23Q3.67 18.23 2.58 17.86Q1.49 17.48 0.68 16.76L0.68 16.76L1.48 15.07Q2.38 15.77 3.19 16.08Q4.00 16.40 4.75 16.40L4.75 16.40Q6.21 16.40 6.98 15.13Q7.76 13.86 7.76 11.48L7.76 11.48L7.76 10.51L8.01 10.96Q7.85 11.74 7.36 12.30Q6.88 12.87 6.17 13.19Q5.45 13.50 4.61 13.50L4.61 13.50Q3.47 13.50 2.58 12.97Q1.69 12.44 1.19 11.51Q0.68 10.58 0.68 9.38L0.68 9.38Q0.68 8.14 1.24 7.17Q1.80 6.21 2.77 5.67Q3.74 5.13 4.99 5.13ZM5.11 6.97L5.11 6.97Q4.10 6.97 3.50 7.61Q2.90 8.24 2.90 9.31L2.90 9.31Q2.90 10.37 3.50 11.01Q4.10 11.65 5.11 11.65L5.11 11.65Q5.78 11.65 6.30 11.35Q6.82 11.05 7.10 10.52Q7.38 9.99 7.38 9.31L7.38 9.31Q7.38 8.60 7.10 8.08Q6.82 7.56 6.30 7.26Q5.78 6.97 5.11 6.97Z',
+}
+GLYPH_ADVANCE = {'-': 7.88}
+DIGIT_ADVANCE = 10.80
+
+SVG_TOKEN_RE = re.compile(r'[A-Z]|[\d.]+')
+
+
+def render_number(number: str) -> str:
+    # every command takes x y pairs, so every other number is an x coordinate
+    path: List[str] = []
+    dx: float = 0.
+    for char in number:
+        nnumbers: int = 0
+        for token in SVG_TOKEN_RE.findall(GLYPHS[char]):
+            if token.isalpha():
+                path.append(token)
+                continue
+            value: float = float(token) + dx if nnumbers % 2 == 0 else float(token)
+            path.append(f'{value:.2f}' if path[-1].isalpha() else f' {value:.2f}')
+            nnumbers += 1
+        dx += GLYPH_ADVANCE.get(char, DIGIT_ADVANCE)
+    return ''.join(path)
+
+
+def render_svg(number: str) -> str:
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="60" height="24">'
+        f'<path d="{render_number(number)}" fill="#000"/></svg>')
+
+
+def render_widget(address: str, values: Dict[str, str]) -> str:
+    measurements: str = ''.join(
+        '<div class="measurement">'
+        f'<h2 class="measurement__name">{name}</h2>'
+        f'<div class="measurement__value">{render_svg(value)}</div>'
+        '</div>'
+        for name, value in values.items())
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Airly</title>'
+        '<style>' + 'body{margin:0}' * 200 + '</style></head><body>'
+        '<div class="summary"><table><tr>'
+        f'<td class="summary__address"> {address} </td>'
+        '</tr></table></div>'
+        f'<div class="measurements">{measurements}</div>'
+        '<footer><script>' + 'var x=0;' * 400 + '</script></footer>'
+        '</body></html>')
+
+
+def random_values(rng: random.Random) -> Dict[str, str]:
+    return {
+        'PM10': str(rng.randint(0, 400)),
+        'PM2.5': str(rng.randint(0, 300)),
+        'PM1': str(rng.randint(0, 200)),
+        'HUMIDITY': str(rng.randint(-20, 100)),
+    }
+
+
+def load_fixtures() -> Dict[str, str]:
+    return {path.name: path.read_text(encoding='utf-8')
+            for path in sorted(FIXTURES_DIR.glob('*.html'))}
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered: List[float] = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def measure(func: Callable[[], Any], repeat: int, ops: int=1) -> Dict[str, float]:
+    samples: List[float] = []
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started: float = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - started)
+    finally:
+        gc.enable()
+    return dict(
+        throughput=ops * len(samples) / sum(samples),
+        p50=percentile(samples, .50),
+        p99=percentile(samples, .99),
+    )
+
+
+class WidgetHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, keep-alive would stall on Nagle
+    disable_nagle_algorithm = True
+    pages: List[bytes] = []
+
+    def do_GET(self):
+        page: bytes = self.pages[zlib.crc32(self.path.encode()) % len(self.pages)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_widget_server(pages: List[str]) -> Tuple[ThreadingHTTPServer, str]:
+    WidgetHandler.pages = [page.encode('utf-8') for page in pages]
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WidgetHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def run_benchmarks(repeat: int, sensors: int, cycles: int, workers: int) -> Dict[str, Dict[str, float]]:
+    fixtures: Dict[str, str] = load_fixtures()
+    rng = random.Random(0)
+    numbers: List[str] = [str(rng.randint(0, 999)) for _ in range(256)]
+    paths: List[str] = [render_number(number) for number in numbers]
+    svgs: List[str] = [render_svg(number) for number in numbers]
+    pages: List[str] = list(fixtures.values())
+
+    results: Dict[str, Dict[str, float]] = {}
+    results['svg_path_reduce'] = measure(
+        lambda: [pusher.svg_path_reduce(path) for path in paths], repeat, len(paths))
+    results['svg_path_to_number'] = measure(
+        lambda: pusher.svg_paths_to_numbers(paths), repeat, len(paths))
+    results['collate_svg_paths'] = measure(
+        lambda: [pusher.collate_svg_paths(svg) for svg in svgs], repeat, len(svgs))
+    results['extract_widget'] = measure(
+        lambda: [pusher.extract_widget([page]) for page in pages], repeat, len(pages))
+
+    server, base = start_widget_server(
+        [render_widget(f'Synthetic {ix}', random_values(rng)) for ix in range(64)])
+    try:
+        urls: Dict[str, str] = {f'sensor{ix}': f'{base}/widget?id={ix}' for ix in range(sensors)}
+        session = pusher.requests_retry_session(retries=0, pool_maxsize=workers)
+        results['pull_measurements'] = measure(
+            lambda: pusher.pull_measurements(retries=0, timeout=5, workers=workers,
+                session=session, sensors=urls),
+            cycles, sensors)
+    finally:
+        server.shutdown()
+    return results
+
+
+def main(
+    save: ("Store results as the new baseline", "flag", "S"),
+    fixtures: ("(Re)generate synthetic widget fixtures", "flag", "F"),
+    repeat: ("Repetitions of each micro benchmark.", "option", 'n', int)=50,
+    sensors: ("Number of synthetic sensors in the pull cycle benchmark.", "option", 's', int)=100,
+    cycles: ("Number of pull cycles.", "option", 'c', int)=10,
+    workers: ("Number of sensors pulled concurrently.", "option", 'w', int)=8,
+    tolerance: ("Allowed p50 slowdown against the baseline, as a fraction.", "option", 'T', float)=.25,
+    ):
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if fixtures:
+        rng = random.Random(0)
+        FIXTURES_DIR.mkdir(parents=True, exist_ok=True)
+        for ix in range(8):
+            values: Dict[str, str] = random_values(rng)
+            name: str = '_'.join(values[key] for key in ('PM10', 'PM2.5', 'PM1'))
+            (FIXTURES_DIR / f'widget_{name}.html').write_text(
+                render_widget(f'Synthetic {ix}', values), encoding='utf-8')
+        return os.EX_OK
+
+    config: Dict[str, int] = dict(repeat=repeat, sensors=sensors, cycles=cycles, workers=workers)
+    results = run_benchmarks(**config)
+    baseline: Dict[str, Any] = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    if baseline and baseline['config'] != config:
+        logging.warning(f'Baseline was recorded with {baseline["config"]}, not comparing.')
+        baseline = {}
+
+    regressions: int = 0
+    print(f'{"benchmark":<20s}{"ops/s":>12s}{"p50 ms":>10s}{"p99 ms":>10s}{"base p50":>10s}')
+    for name, result in results.items():
+        base: Union[Dict[str, float], None] = baseline.get('results', {}).get(name)
+        flag: str = ''
+        if base is not None and result['p50'] > base['p50'] * (1 + tolerance):
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f'{name:<20s}{result["throughput"]:>12.0f}{result["p50"] * 1e3:>10.3f}{result["p99"] * 1e3:>10.3f}'
+              f'{base["p50"] * 1e3 if base else float("nan"):>10.3f}{flag}')
+
+    if save:
+        BASELINE.parent.mkdir(parents=True, exist_ok=True)
+        BASELINE.write_text(json.dumps(dict(config=config, results=results), indent=2) + '\n')
+    return 1 if regressions else os.EX_OK
+
+if __name__ == '__main__':
+    sys.exit(plac.call(main))
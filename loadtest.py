@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import resource
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Tuple, Union, Any
+import plac
+
+import bench
+import pusher
+
+
+PICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pics')
+
+
+class AirlyHandler(bench.WidgetHandler):
+    latency: float = 0.
+    errors: float = 0.
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(random.expovariate(1. / self.latency))
+        if random.random() < self.errors:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+class MastodonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency: float = 0.
+    errors: float = 0.
+    # requests allowed per token within a window, like Mastodon's per-account limits
+    rate_limit: int = 300
+    rate_window: float = 300.
+    lock = threading.Lock()
+    buckets: Dict[str, List[float]] = {}
+    counters: Dict[str, int] = {}
+
+    def count(self, name: str) -> int:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            return self.counters[name]
+
+    def reply(self, status: int, body: Dict[str, Any], headers: Dict[str, str]):
+        data: bytes = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path not in ('/api/v1/media', '/api/v1/statuses'):
+            self.reply(404, dict(error='Record not found'), {})
+            return
+        if self.latency:
+            time.sleep(random.expovariate(1. / self.latency))
+
+        now: float = time.time()
+        with self.lock:
+            bucket: Union[List[float], None] = self.buckets.get(self.headers.get('Authorization', ''))
+            if bucket is None or now >= bucket[1]:
+                bucket = self.buckets[self.headers.get('Authorization', '')] = [self.rate_limit, now + self.rate_window]
+            bucket[0] -= 1
+            remaining, reset = bucket
+        headers: Dict[str, str] = {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(max(0, int(remaining))),
+            'X-RateLimit-Reset': datetime.fromtimestamp(reset, timezone.utc).isoformat(),
+        }
+        if remaining < 0:
+            self.count('429')
+            self.reply(429, dict(error='Too many requests'), headers)
+        elif random.random() < self.errors:
+            self.count('503')
+            self.reply(503, dict(error='Service unavailable'), headers)
+        elif self.path == '/api/v1/media':
+            self.reply(200, dict(id=str(self.count('media'))), headers)
+        else:
+            self.reply(200, dict(id=str(self.count('statuses'))), headers)
+
+    def log_message(self, *args):
+        pass
+
+
+class AlwaysAlertingStore(pusher.SqliteStateStore):
+    # state is still written, but every cycle is treated as the first one and alerts
+    def transition(self, *args, **kwargs) -> None:
+        super().transition(*args, **kwargs)
+        return None
+
+
+def start_server(handler: type) -> Tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def distribution(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return dict(p50=float('nan'), p95=float('nan'), p99=float('nan'))
+    return dict(p50=bench.percentile(samples, .50), p95=bench.percentile(samples, .95),
+                p99=bench.percentile(samples, .99))
+
+
+def run_load(sensors: int, destinations: int, hosts: int, cycles: int, workers: int
+    ) -> Dict[str, Any]:
+    rng = random.Random(0)
+    AirlyHandler.pages = [bench.render_widget(f'Synthetic {ix}', bench.random_values(rng)).encode('utf-8')
+                          for ix in range(64)]
+    airly, airly_base = start_server(AirlyHandler)
+    mastodons: List[Tuple[ThreadingHTTPServer, str]] = [start_server(MastodonHandler) for _ in range(hosts)]
+
+    urls: Dict[str, str] = {f'sensor{ix}': f'{airly_base}/widget?id={ix}' for ix in range(sensors)}
+    accounts: List[pusher.Destination] = [
+        pusher.Destination(f'account{ix}', mastodons[ix % hosts][1], f'token{ix}') for ix in range(destinations)]
+    session = pusher.requests_retry_session(retries=3, pool_maxsize=workers)
+    media_cache = pusher.JsonFileCache(None, ttl=pusher.MEDIA_CACHE_TTL)
+
+    pulls: List[float] = []
+    pushes: List[float] = []
+    request_times: List[float] = []
+    posts: List[float] = []
+    pulled: int = 0
+    counters: Dict[str, int] = {}
+    pusher.METRICS.enabled = True
+    tracemalloc.start()
+    cwd: str = os.getcwd()
+    # alert pictures are resolved relative to the working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        os.symlink(PICS_DIR, os.path.join(workdir, 'pics'))
+        os.chdir(workdir)
+        state = AlwaysAlertingStore(os.path.join(workdir, 'state.db'))
+        try:
+            for cycle in range(cycles):
+                pusher.METRICS.reset()
+                started: float = time.perf_counter()
+                measurements = pusher.pull_measurements(retries=3, timeout=5, workers=workers,
+                    session=session, sensors=urls)
+                pulls.append(time.perf_counter() - started)
+                pulled += len(measurements)
+
+                started = time.perf_counter()
+                pusher.push_aqi_status(measurements, state=state, destinations=accounts,
+                    media_cache=media_cache)
+                pushes.append(time.perf_counter() - started)
+
+                summary: Dict[str, Any] = pusher.METRICS.summary()
+                request_times += summary['phases'].get('request', {}).values()
+                posts += summary['phases'].get('status_post', {}).values()
+                for counter, values in summary['counters'].items():
+                    counters[counter] = counters.get(counter, 0) + sum(values.values())
+        finally:
+            os.chdir(cwd)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            pusher.METRICS.enabled = False
+            session.close()
+            airly.shutdown()
+            for server, _ in mastodons:
+                server.shutdown()
+
+    return dict(
+        pull=dict(throughput=sensors * cycles / sum(pulls), pulled=pulled, expected=sensors * cycles,
+                  cycle=distribution(pulls), request=distribution(request_times)),
+        push=dict(throughput=destinations * cycles / sum(pushes),
+                  delivered=MastodonHandler.counters.get('statuses', 0), expected=destinations * cycles,
+                  cycle=distribution(pushes), status_post=distribution(posts)),
+        server=dict(MastodonHandler.counters),
+        client=counters,
+        memory=dict(traced_peak=peak, max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+    )
+
+
+def main(
+    sensors: ("Number of synthetic sensors.", "option", 's', int)=100,
+    destinations: ("Number of Mastodon accounts alerts are posted to.", "option", 'm', int)=10,
+    hosts: ("Number of Mastodon stand-in servers the accounts are spread over.", "option", 'H', int)=2,
+    cycles: ("Number of pull and push cycles.", "option", 'c', int)=5,
+    workers: ("Number of sensors pulled concurrently.", "option", 'w', int)=8,
+    airly_latency: ("Mean widget response latency, in seconds.", "option", 'al', float)=.02,
+    airly_errors: ("Fraction of widget requests failing with 503.", "option", 'ae', float)=0.,
+    mastodon_latency: ("Mean Mastodon response latency, in seconds.", "option", 'ml', float)=.05,
+    mastodon_errors: ("Fraction of Mastodon requests failing with 503.", "option", 'me', float)=0.,
+    rate_limit: ("Mastodon requests allowed per account within a window.", "option", 'rl', int)=300,
+    rate_window: ("Mastodon rate limit window, in seconds.", "option", 'rw', float)=300.,
+    output: ("JSON file to write the results to.", "option", 'o')=None,
+    ):
+
+    logging.basicConfig(level=logging.ERROR)
+    AirlyHandler.latency = airly_latency
+    AirlyHandler.errors = airly_errors
+    MastodonHandler.latency = mastodon_latency
+    MastodonHandler.errors = mastodon_errors
+    MastodonHandler.rate_limit = rate_limit
+    MastodonHandler.rate_window = rate_window
+
+    results: Dict[str, Any] = run_load(sensors, destinations, hosts, cycles, workers)
+
+    pull: Dict[str, Any] = results['pull']
+    push: Dict[str, Any] = results['push']
+    print(f'{"stage":<14s}{"ops/s":>10s}{"done":>12s}{"p50 ms":>10s}{"p95 ms":>10s}{"p99 ms":>10s}')
+    for stage, throughput, done, stats in (
+            ('pull cycle', f'{pull["throughput"]:.1f}', f'{pull["pulled"]}/{pull["expected"]}', pull['cycle']),
+            ('  request', '', '', pull['request']),
+            ('push cycle', f'{push["throughput"]:.1f}', f'{push["delivered"]}/{push["expected"]}', push['cycle']),
+            ('  status_post', '', '', push['status_post'])):
+        print(f'{stage:<14s}{throughput:>10s}{done:>12s}'
+              f'{stats["p50"] * 1e3:>10.1f}{stats["p95"] * 1e3:>10.1f}{stats["p99"] * 1e3:>10.1f}')
+    print(f'server responses: {results["server"]}')
+    print(f'client events: {results["client"]}')
+    print(f'memory: traced peak {results["memory"]["traced_peak"] / 2**20:.1f} MiB, '
+          f'max RSS {results["memory"]["max_rss"] / 2**20:.1f} MiB')
+
+    if output:
+        pusher.write_atomically(output, json.dumps(results, indent=2) + '\n')
+    return os.EX_OK
+
+if __name__ == '__main__':
+    sys.exit(plac.call(main))
@@ -2,22 +2,43 @@
 # -*- coding: utf-8 -*-
 
 import os
+import io
+import csv
+import tarfile
+import tempfile
+import zlib
+import bisect
+import statistics
+import math
+import mmap
+import struct
+import contextlib
+import json
+import hashlib
+import heapq
+import itertools
+import uuid
 import sys
 import re
 import logging
+import signal
+import queue
+import subprocess
+import time
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from datetime import datetime
 from pathlib import Path
-import plac
-from typing import Dict, List, Set, Tuple, Union, Any
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union, Any
 
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+# requests, urllib3 and lxml are imported where they are first needed,
+# the glyph tests and history reports start without the network stack
+if TYPE_CHECKING:
+    import requests
+    from requests.packages.urllib3.util.retry import Retry
+    from lxml import etree
 
-from xml.dom import minidom
-
-
-MASTODON_HOST = ''
-MASTODON_TOKEN = ''
 
 AQI_PM25_LEVELS = {
     'Good' : dict(hi=12.0,
@@ -56,14 +77,8 @@ humidity    %
 temperature F
 wind        mph
 """
-SENSORS = {
-    'Mikolajska':       'https://airly.org/widget/v2/?width=280&height=380&displayMeasurements=true&displayCAQI=false&autoHeight=true&autoWidth=false&language=en&indexType=AIRLY_US_AQI&unitSpeed=imperial&unitTemperature=fahrenheit&latitude=50.062006&longitude=19.940984&locationId=8077',
-    'Szpitalna':        'https://airly.org/widget/v2/?width=280&height=380&displayMeasurements=true&displayCAQI=false&autoHeight=true&autoWidth=false&language=en&indexType=AIRLY_US_AQI&unitSpeed=imperial&unitTemperature=fahrenheit&latitude=50.064539&longitude=19.942561&locationId=10213',
-    'Franciszkanska':   'https://airly.org/widget/v2/?width=280&height=380&displayMeasurements=true&displayCAQI=false&autoHeight=true&autoWidth=false&language=en&indexType=AIRLY_US_AQI&unitSpeed=imperial&unitTemperature=fahrenheit&latitude=50.059085&longitude=19.933919&locationId=10211',
-    'Warszawska':       'https://airly.org/widget/v2/?width=280&height=380&displayMeasurements=true&displayCAQI=false&autoHeight=true&autoWidth=false&language=en&indexType=AIRLY_US_AQI&unitSpeed=imperial&unitTemperature=fahrenheit&latitude=50.070088&longitude=19.943812&locationId=10048',
-    'Studencka':        'https://airly.org/widget/v2/?width=280&height=380&displayMeasurements=true&displayCAQI=false&autoHeight=true&autoWidth=false&language=en&indexType=AIRLY_US_AQI&unitSpeed=imperial&unitTemperature=fahrenheit&latitude=50.062418&longitude=19.928368&locationId=9910',
-    'Straszewskiego':   'https://airly.org/widget/v2/?width=280&height=380&displayMeasurements=true&displayCAQI=false&autoHeight=true&autoWidth=false&language=en&indexType=AIRLY_US_AQI&unitSpeed=imperial&unitTemperature=fahrenheit&latitude=50.057224&longitude=19.933157&locationId=57570',
-}
+# region -> sensor -> template parameters, see load_sensor_registry
+SENSOR_REGISTRY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensors.json')
 
 
 CHAR_MAP = {
@@ -81,18 +96,82 @@ CHAR_MAP = {
 }
 
 
+# 1. isolated numbers
+# 2. numbers which follow uppercase letter
+SVG_PATH_REDUCE_RE = re.compile(r'(?<= )[\d.]+(?= )|(?<=[A-Z])[\d.]+')
+# dropping every number followed by a space leaves the commands and the y
+# of each end point, which is what tells glyphs apart wherever they are drawn
+SVG_PATH_KEY_RE = re.compile(r'[\d.*]+ ')
+# x of the initial moveto of every subpath
+SVG_MOVETO_RE = re.compile(r'M([\d.]+)')
+
+
 def svg_path_reduce(path: str) -> str:
-    # 1. remove isolated numbers
-    # 2. remove numbers which follow uppercase letter
-    path = re.sub(r'(?<= )[\d.]+(?= )', '*', path)
-    return re.sub(r'(?<=[A-Z])[\d.]+', '*', path)
+    return SVG_PATH_REDUCE_RE.sub('*', path)
+
+
+def svg_path_key(path: str) -> str:
+    return SVG_PATH_KEY_RE.sub('', path)
+
+
+def compile_glyph_trie(char_map: Dict[str, str]) -> Dict[str, Any]:
+    # glyphs like 0, 8 or 9 span several subpaths, so the trie is keyed by
+    # the key of each closed subpath; None marks a complete glyph
+    trie: Dict[str, Any] = {}
+    for char, signature in char_map.items():
+        node = trie
+        for subpath in svg_path_key(signature).split('Z')[:-1]:
+            node = node.setdefault(subpath, {})
+        node[None] = char
+    return trie
+
+
+GLYPH_TRIE: Dict[str, Any] = compile_glyph_trie(CHAR_MAP)
+
+
+def decode_glyphs(path: str) -> List[Tuple[float, str]]:
+    # the whole path is keyed in one pass and split into its closed subpaths,
+    # text which is not one of them fails the trie lookup
+    *subpaths, rest = svg_path_key(path).split('Z')
+    if rest:
+        raise ValueError(f'Unexpected path text: {rest[:32]}')
+    if not subpaths:
+        raise ValueError('No glyphs in path')
+    xs: List[str] = SVG_MOVETO_RE.findall(path)
+    if len(xs) != len(subpaths):
+        raise ValueError(f'Expected {len(subpaths)} subpaths found {len(xs)} movetos')
+    glyphs: List[Tuple[float, str]] = []
+    ix = 0
+    while ix < len(subpaths):
+        # longest match of consecutive subpaths
+        node = GLYPH_TRIE
+        char, end = None, ix
+        for jx in range(ix, len(subpaths)):
+            node = node.get(subpaths[jx])
+            if node is None:
+                break
+            if None in node:
+                char, end = node[None], jx + 1
+        if char is None:
+            raise ValueError(f'Unknown glyph at x={xs[ix]}: {subpaths[ix][:32]}')
+        glyphs.append((float(xs[ix]), char))
+        ix = end
+    return sorted(glyphs)
 
 
 def svg_path_to_number(path: str) -> str:
-    path = svg_path_reduce(path)
-    for char, signature in CHAR_MAP.items():
-        path = path.replace(signature, f'|{char}|')
-    return path.replace('|', '')
+    return ''.join(char for _, char in decode_glyphs(path))
+
+
+def svg_paths_to_numbers(paths: Iterable[str]) -> List[Union[str, None]]:
+    numbers: List[Union[str, None]] = []
+    for path in paths:
+        try:
+            numbers.append(svg_path_to_number(path))
+        except ValueError as e:
+            logging.error(f'Glyph decoding failure: {e}')
+            numbers.append(None)
+    return numbers
 
 
 def test_character_recognition():
@@ -171,119 +250,1258 @@ def test_number_recognition():
         assert svg_path_to_number(path) == number, f'Number expected {number} found {svg_path_to_number(path)}'
 
 
+def test_history_store():
+    with tempfile.TemporaryDirectory() as workdir:
+        store = HistoryStore(os.path.join(workdir, 'history.bin'))
+        for t in range(10):
+            store.append(1000. + t, {'north': {'pm2.5': str(t)}, 'south': {'pm2.5': str(2 * t), 'pm10': 'x'}})
+        records = list(store.scan())
+        assert len(records) == 20, f'Records expected 20 found {len(records)}'
+        window = list(store.scan(since=1003., until=1005.))
+        assert [r[0] for r in window] == [1003., 1003., 1004., 1004., 1005., 1005.], f'Window scan found {window}'
+        south = list(store.scan(since=1008., sensor='south'))
+        assert [(r[0], r[1], r[3]) for r in south] == [(1008., 'south', 16.), (1009., 'south', 18.)], \
+            f'Sensor scan found {south}'
+        assert math.isnan(south[0][4]), f'Unparseable PM10 expected NaN found {south[0][4]}'
+        assert not list(store.scan(sensor='west')), 'Unknown sensor expected no records'
+
+        # a crash mid-write leaves a partial record, the next append drops it
+        with open(store.path, 'ab') as ofile:
+            ofile.write(HISTORY_RECORD.pack(1010., 0, 1., 1., 1.)[:7])
+        reopened = HistoryStore(store.path)
+        reopened.append(1011., {'south': {'pm2.5': '5'}})
+        assert os.path.getsize(store.path) == 21 * HISTORY_RECORD.size, 'Torn record expected truncated'
+        last = list(reopened.scan(since=1010.))
+        assert [(r[0], r[1], r[3]) for r in last] == [(1011., 'south', 5.)], f'Recovered scan found {last}'
+
+
+def test_state_store():
+    with tempfile.TemporaryDirectory() as workdir:
+        store = open_state_store(f'sqlite:{os.path.join(workdir, "state.db")}')
+        former = store.transition('north', 'Good', False, 5., {'a': {'pm2.5': '5', 'pm10': '9'}})
+        assert former is None, f'First transition expected no former state found {former}'
+        former = store.transition('north', 'Unhealthy', True, 60., {'a': {'pm2.5': '60'}})
+        assert former is False, f'Former state expected False found {former}'
+        former = store.transition('south', 'Good', False, 3., {'b': {'pm1': '1', 'pm2.5': '3'}})
+        assert former is None, f'Regions expected independent, south found {former}'
+        former = store.transition('north', 'Good', False, 7., {'a': {'pm2.5': '7'}})
+        assert former is True, f'Former state expected True found {former}'
+
+        alerts = store.alerts()
+        assert {region: alert['aqi'] for region, alert in alerts.items()} == dict(north='Good', south='Good'), \
+            f'Alerts {alerts}'
+        # a reading missing from the latest pull is not kept from an earlier one
+        values = store.last_values('north')
+        assert values == {'a': {'pm2.5': 7.}}, f'Last values {values}'
+        values = store.last_values('south')
+        assert values == {'b': {'pm1': 1., 'pm2.5': 3.}}, f'Last values {values}'
+
+        files = open_state_store(f'file:{workdir}')
+        assert files.transition(DEFAULT_REGION, 'Good', False, 5., {}) is None, 'File store expected no former state'
+        assert files.transition(DEFAULT_REGION, 'Moderate', True, 20., {}) is False, 'File store former state'
+        assert files.alerts()[DEFAULT_REGION]['aqi'] == 'Moderate', f'File store alerts {files.alerts()}'
+        try:
+            files.transition('north', 'Good', False, 5., {})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('File store expected to reject another region')
+        try:
+            open_state_store(f'file:{workdir}', ['north', DEFAULT_REGION])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('File store expected to refuse a registry with other regions')
+
+
+def test_fan_out():
+    class Response:
+        def __init__(self, status_code: int, headers: Dict[str, str]):
+            self.status_code: int = status_code
+            self.headers: Dict[str, str] = headers
+
+    calls: Dict[str, List[float]] = {}
+
+    def deliver(destination: Destination) -> Tuple[bool, Union[float, None]]:
+        calls.setdefault(destination.name, []).append(time.time())
+        if destination.ready_at() > time.time():
+            return False, destination.ready_at()
+        if destination.name == 'limited' and len(calls['limited']) == 1:
+            reset: str = datetime.fromtimestamp(time.time() + .2).astimezone().isoformat()
+            destination.update_limits(Response(429, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset}))
+            return False, destination.ready_at()
+        if destination.name == 'down':
+            return False, time.time()
+        if destination.name == 'broken':
+            return False, None
+        if destination.name == 'far':
+            return False, time.time() + 2 * POST_MAX_DELAY
+        return True, None
+
+    names = ('ok', 'limited', 'down', 'broken', 'far')
+    delivered = fan_out([Destination(name, 'http://localhost', name) for name in names], deliver,
+        attempts=3, backoff=.01)
+    assert delivered == dict(ok=True, limited=True, down=False, broken=False, far=False), f'Delivered {delivered}'
+    assert len(calls['limited']) == 2, f'Rate limited destination expected 2 calls found {len(calls["limited"])}'
+    assert calls['limited'][1] - calls['limited'][0] >= .15, 'Rate limited destination retried before its reset'
+    attempts = {name: len(calls[name]) for name in names}
+    assert attempts == dict(ok=1, limited=2, down=3, broken=1, far=1), f'Attempts {attempts}'
+
+
+# modules which only the network and parsing paths need
+HEAVY_MODULES = ('requests', 'urllib3', 'lxml', 'plac')
+IMPORT_BUDGET = 0.15
+
+
+def test_import_budget(budget: float=IMPORT_BUDGET):
+    script = ('import sys, time; started = time.perf_counter(); import pusher; '
+        'print(time.perf_counter() - started, *sorted(set(sys.modules) & set(pusher.HEAVY_MODULES)))')
+    out: str = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True,
+        text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    elapsed, *loaded = out.split()
+    assert not loaded, f'Import loaded {", ".join(loaded)}'
+    assert float(elapsed) <= budget, f'Import took {float(elapsed):.3f}s, budget {budget:.3f}s'
+
+
+# run-wide deadline of the pull running on the current thread, retries stop once it passes
+RETRY_DEADLINE = threading.local()
+# retries made on the current thread since the last recorded response
+RETRY_COUNT = threading.local()
+
+
 def requests_retry_session(
     retries: int=3,
     backoff_factor: float=0.3,
     status_forcelist: Tuple[int]=(500, 502, 503, 504),
-    session: Union[requests.Session, None]=None,
-) -> requests.Session:
+    session: Union['requests.Session', None]=None,
+    pool_maxsize: int=10,
+) -> 'requests.Session':
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+
+    class DeadlineRetry(Retry):
+        def remaining(self) -> Union[float, None]:
+            deadline_at: Union[float, None] = getattr(RETRY_DEADLINE, 'at', None)
+            return None if deadline_at is None else deadline_at - time.monotonic()
+
+        def is_exhausted(self) -> bool:
+            remaining: Union[float, None] = self.remaining()
+            return (remaining is not None and remaining <= 0) or super().is_exhausted()
+
+        def sleep(self, response=None):
+            remaining: Union[float, None] = self.remaining()
+            if remaining is None:
+                return super().sleep(response)
+            # never back off past the deadline, the next attempt would not be used anyway
+            time.sleep(max(0., min(self.get_backoff_time(), remaining)))
+
+        def increment(self, *args, **kwargs) -> 'Retry':
+            # counted here rather than from a response, requests which ran out
+            # of retries have none; an exhausting call raises and is not a retry
+            retry: Retry = super().increment(*args, **kwargs)
+            RETRY_COUNT.n = getattr(RETRY_COUNT, 'n', 0) + 1
+            return retry
+
     session: requests.Session = session or requests.Session()
-    retry = Retry(
+    retry = DeadlineRetry(
         total=retries,
         read=retries,
         connect=retries,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
+class PhaseTimer:
+    def __init__(self, metrics: 'Metrics', phase: str, sensor: str):
+        self.metrics = metrics
+        self.phase: str = phase
+        self.sensor: str = sensor
+
+    def __enter__(self):
+        self.started: float = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.phase, self.sensor, time.perf_counter() - self.started)
+        return False
+
+
+class Metrics:
+    def __init__(self, enabled: bool=False):
+        self.enabled: bool = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started: float = time.time()
+        self.phases: Dict[Tuple[str, str], float] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}
+
+    def timer(self, phase: str, sensor: str=''):
+        # a disabled timer is one shared no-op context manager
+        if not self.enabled:
+            return NULL_TIMER
+        return PhaseTimer(self, phase, sensor)
+
+    def observe(self, phase: str, sensor: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.phases[phase, sensor] = self.phases.get((phase, sensor), 0.) + seconds
+
+    def count(self, counter: str, sensor: str='', n: int=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counter, sensor] = self.counters.get((counter, sensor), 0) + n
+
+    def record_response(self, phase: str, sensor: str, res: Union['requests.Response', None]):
+        # None records a request which failed, after its retries if any
+        retries: int = getattr(RETRY_COUNT, 'n', 0)
+        RETRY_COUNT.n = 0
+        if not self.enabled:
+            return
+        self.count('retries', sensor, retries)
+        if res is not None:
+            self.observe(f'{phase}_ttfb', sensor, res.elapsed.total_seconds())
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            phases: Dict[str, Dict[str, float]] = {}
+            for (phase, sensor), seconds in self.phases.items():
+                phases.setdefault(phase, {})[sensor] = seconds
+            counters: Dict[str, Dict[str, int]] = {}
+            for (counter, sensor), n in self.counters.items():
+                counters.setdefault(counter, {})[sensor] = n
+        return dict(started=self.started, phases=phases, counters=counters)
+
+    def export_json(self, path: str):
+        write_atomically(path, json.dumps(self.summary(), indent=2, ensure_ascii=False) + '\n')
+
+    def export_prometheus(self, path: str):
+        def label(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        with self.lock:
+            lines: List[str] = [
+                '# HELP pusher_last_run_timestamp_seconds Start of the last run.',
+                '# TYPE pusher_last_run_timestamp_seconds gauge',
+                f'pusher_last_run_timestamp_seconds {self.started:.3f}',
+                '# HELP pusher_phase_seconds Time spent in a phase of the last run.',
+                '# TYPE pusher_phase_seconds gauge',
+            ]
+            lines += [f'pusher_phase_seconds{{phase="{label(phase)}",sensor="{label(sensor)}"}} {seconds:.6f}'
+                      for (phase, sensor), seconds in sorted(self.phases.items())]
+            lines += [
+                '# HELP pusher_events Number of events during the last run.',
+                '# TYPE pusher_events gauge',
+            ]
+            lines += [f'pusher_events{{event="{label(counter)}",sensor="{label(sensor)}"}} {n}'
+                      for (counter, sensor), n in sorted(self.counters.items())]
+        write_atomically(path, '\n'.join(lines) + '\n')
+
+
+NULL_TIMER = contextlib.nullcontext()
+METRICS = Metrics()
+
+
+def write_atomically(path: str, text: str):
+    tmp: str = f'{path}.tmp'
+    with open(tmp, 'wt') as ofile:
+        ofile.write(text)
+    os.replace(tmp, path)
+
+
+def export_metrics(metrics_prom: Union[str, None], metrics_json: Union[str, None]):
+    if metrics_prom:
+        METRICS.export_prometheus(metrics_prom)
+    if metrics_json:
+        METRICS.export_json(metrics_json)
+
+
 def collate_svg_paths(svg: str) -> str:
-    doc = minidom.parseString(svg)
+    from lxml import etree
 
-    paths: List[str] = [path.getAttribute('d')
-                        for path in doc.getElementsByTagName('path')]
-    doc.unlink()
+    paths: List[str] = []
+    for _, path in etree.iterparse(io.BytesIO(svg.encode()), events=('end',), tag='{*}path'):
+        paths.append(path.get('d', ''))
+        path.clear()
     return ''.join(paths)
 
 
-def pull_measurements(retries: int, timeout: int) -> Dict[str, Dict[str, str]]:
-    session: requests.Session = requests_retry_session(retries=retries)
-    meas: Dict[str, Dict[str, str]] = {}
+#KEYS = set(('PM10', 'PM2.5', 'PM1', 'PRESSURE', 'HUMIDITY', 'TEMPERATURE', 'WIND_SPEED')) # API v1
+WIDGET_KEYS = frozenset(('PM10', 'PM2.5', 'PM1')) # API v2
+
+# HTMLPullParser resets on close() and can be fed again, one per pulling thread
+WIDGET_PARSERS = threading.local()
+
+
+def extract_widget(chunks: Iterable[Union[str, bytes]]
+    ) -> Tuple[Union[str, None], int, Dict[str, str]]:
+    from lxml import etree
 
-    def download(url: str):
+    parser: Union[etree.HTMLPullParser, None] = getattr(WIDGET_PARSERS, 'parser', None)
+    if parser is None:
+        parser = WIDGET_PARSERS.parser = etree.HTMLPullParser(events=('start', 'end'))
+
+    address: Union[str, None] = None
+    nmeasurements: int = 0
+    paths: Dict[str, str] = {}
+    depth: int = 0
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, el in parser.read_events():
+                klass: Union[str, None] = el.get('class')
+                if event == 'start':
+                    if klass == 'measurement':
+                        depth += 1
+                    continue
+                if klass == 'summary__address':
+                    address = (el.text or '').strip()
+                elif klass == 'measurement':
+                    depth -= 1
+                    nmeasurements += 1
+                    name: Union[etree._Element, None] = el.find('.//h2[@class="measurement__name"]')
+                    path: Union[etree._Element, None] = el.find('.//div[@class="measurement__value"]//path')
+                    if name is not None and path is not None and (name.text or '').strip() in WIDGET_KEYS:
+                        paths[name.text.strip().lower()] = path.get('d', '')
+                if depth == 0:
+                    # drop everything outside of the measurement blocks
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
+            if address is not None and len(paths) == len(WIDGET_KEYS):
+                break
+    finally:
         try:
-            res = session.get(url, timeout=timeout)
-        except requests.exceptions.HTTPError as e:
-            logging.error(f"Http failure: {e}")
-            return None
-        except requests.exceptions.ConnectionError as e:
-            logging.error(f"Connection failure: {e}")
-            return None
-        except requests.exceptions.Timeout as e:
-            logging.error(f"Network timeout failure: {e}")
-            return None
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Core requests failure: {e}")
-            return None
+            parser.close()
+        except etree.LxmlError:
+            pass
+        # events left over by an early stop must not leak into the next page
+        for _ in parser.read_events():
+            pass
+    return address, nmeasurements, paths
 
-        if res.status_code < 200 or 300 <= res.status_code:
-            logging.error(f'Http error: status={res.status_code}')
-            return None
 
+def parse_widget(sensor: str, chunks: Iterable[Union[str, bytes]],
+        health: Union['SensorHealth', None]=None,
+    ) -> Union[Dict[str, str], None]:
+    with METRICS.timer('extract', sensor):
+        address, nmeasurements, paths = extract_widget(chunks)
+    if address is None:
+        print(f"[!] Sensor {sensor} does not seem to exist. It is missing 'summary__address' class element.")
+        if health is not None:
+            health.trip(sensor)
+        return None
+
+    if nmeasurements == 0:
+        logging.warning(f'Sensor {sensor} has no measurements.')
+        return None
+
+    with METRICS.timer('decode', sensor):
+        numbers: List[Union[str, None]] = svg_paths_to_numbers(paths.values())
+    params: Dict[str, str] = {
+        name: number for name, number in zip(paths.keys(), numbers) if number is not None}
+    return params or None
+
+
+class JsonFileCache:
+    def __init__(self, path: Union[str, None], ttl: float):
+        self.path: Union[str, None] = path
+        self.ttl: float = ttl
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rt') as ifile:
+                    self.entries = json.load(ifile)
+            except (OSError, ValueError) as e:
+                logging.warning(f'Ignoring unreadable cache {path}: {e}')
+        self.evict()
+
+    def evict(self):
+        now: float = time.time()
+        with self.lock:
+            self.entries = {key: entry for key, entry in self.entries.items()
+                            if now - entry.get('stored', 0) < self.ttl}
+
+    def get(self, key: str) -> Union[Dict[str, Any], None]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry.get('stored', 0) >= self.ttl:
+                del self.entries[key]
+                entry = None
+            return entry
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        with self.lock:
+            self.entries[key] = dict(entry, stored=time.time())
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            write_atomically(self.path, json.dumps(self.entries))
+
+
+def download(url: str, session: 'requests.Session', timeout: float, stream: bool=False,
+        headers: Union[Dict[str, str], None]=None
+    ) -> Union['requests.Response', None]:
+    import requests
+
+    try:
+        res = session.get(url, timeout=timeout, stream=stream, headers=headers)
+    except requests.exceptions.HTTPError as e:
+        logging.error(f"Http failure: {e}")
+        return None
+    except requests.exceptions.ConnectionError as e:
+        logging.error(f"Connection failure: {e}")
+        return None
+    except requests.exceptions.Timeout as e:
+        logging.error(f"Network timeout failure: {e}")
+        return None
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Core requests failure: {e}")
+        return None
+
+    if res.status_code == 304 and headers:
         return res
 
-    for sensor, url in SENSORS.items():
-        res = download(url)
+    if res.status_code < 200 or 300 <= res.status_code:
+        logging.error(f'Http error: status={res.status_code}')
+        res.close()
+        return None
+
+    return res
+
+
+def load_sensor_registry(path: str) -> Dict[str, Dict[str, str]]:
+    # sensors are given by their parameters to the shared URL template,
+    # or by a complete 'url' of their own
+    with open(path, 'rt', encoding='utf-8') as ifile:
+        config: Dict[str, Any] = json.load(ifile)
+    template: str = config.get('template', '')
+    registry: Dict[str, Dict[str, str]] = {}
+    seen: Set[str] = set()
+    for region, sensors in config['regions'].items():
+        for sensor, params in sensors.items():
+            if sensor in seen:
+                raise ValueError(f'Sensor {sensor} is registered more than once in {path}')
+            seen.add(sensor)
+            registry.setdefault(region, {})[sensor] = params.get('url') or template.format(**params)
+    return registry
+
+
+def shard_sensor_registry(registry: Dict[str, Dict[str, str]], shard: int, shards: int
+    ) -> Dict[str, Dict[str, str]]:
+    # stable across processes and hosts, unlike hash()
+    return {region: {sensor: url for sensor, url in sensors.items()
+                     if zlib.crc32(sensor.encode('utf-8')) % shards == shard}
+            for region, sensors in registry.items()}
+
+
+def registry_sensors(registry: Dict[str, Dict[str, str]]) -> Dict[str, str]:
+    return {sensor: url for sensors in registry.values() for sensor, url in sensors.items()}
+
+
+def merge_measurements(paths: List[str], registry: Dict[str, Dict[str, str]]
+    ) -> Dict[str, Dict[str, str]]:
+    merged: Dict[str, Dict[str, str]] = {}
+    for path in paths:
+        with open(path, 'rt', encoding='utf-8') as ifile:
+            merged.update(json.load(ifile))
+    # shards finish in any order, restore the registry one
+    order: Dict[str, int] = {sensor: ix for ix, sensor in enumerate(registry_sensors(registry))}
+    return dict(sorted(merged.items(), key=lambda item: order.get(item[0], len(order))))
+
+
+def pull_sensor(sensor: str, url: str, session: 'requests.Session',
+        timeout: float, deadline_at: Union[float, None],
+        cache: Union[JsonFileCache, None]=None,
+        health: Union['SensorHealth', None]=None,
+    ) -> Union[Dict[str, str], None]:
+    # never let a single attempt outlive the run-wide deadline, nor retry past it
+    RETRY_DEADLINE.at = deadline_at
+    if deadline_at is not None:
+        timeout = max(min(timeout, deadline_at - time.monotonic()), 0.001)
+
+    if cache is None:
+        with METRICS.timer('request', sensor):
+            res = download(url, session=session, timeout=timeout, stream=True)
+        METRICS.record_response('request', sensor, res)
         if res is None:
+            METRICS.count('failures', sensor)
             logging.warning(f'Pulling measurements for sensor {sensor} failed.')
+            return None
+        with res:
+            # feed text like res.text would decode it, stop parsing once done
+            res.encoding = res.encoding or res.apparent_encoding
+            params = parse_widget(sensor, res.iter_content(chunk_size=8192, decode_unicode=True), health)
+            # discard the unparsed rest so that the connection goes back to the pool
+            res.raw.drain_conn()
+            return params
+
+    entry: Union[Dict[str, Any], None] = cache.get(url)
+    headers: Dict[str, str] = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    with METRICS.timer('request', sensor):
+        res = download(url, session=session, timeout=timeout, headers=headers)
+    METRICS.record_response('request', sensor, res)
+    if res is None:
+        METRICS.count('failures', sensor)
+        logging.warning(f'Pulling measurements for sensor {sensor} failed.')
+        return None
+
+    if res.status_code == 304:
+        METRICS.count('cache_hits', sensor)
+        logging.info(f'Sensor {sensor} not modified, reusing cached measurements.')
+        cache.put(url, entry)
+        return entry['params']
+
+    # servers without validators still let us skip parsing a byte-identical page
+    digest: str = hashlib.sha256(res.content).hexdigest()
+    if entry is not None and entry.get('sha256') == digest:
+        METRICS.count('cache_hits', sensor)
+        logging.info(f'Sensor {sensor} unchanged, reusing cached measurements.')
+        cache.put(url, entry)
+        return entry['params']
+
+    params = parse_widget(sensor, [res.text], health)
+    if params:
+        cache.put(url, dict(
+            etag=res.headers.get('ETag'),
+            last_modified=res.headers.get('Last-Modified'),
+            sha256=digest,
+            params=params))
+    return params
+
+
+class DaemonThreadPool:
+    # a minimal ThreadPoolExecutor on daemon threads, stragglers abandoned
+    # at the deadline never keep the interpreter from exiting
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self.tasks: queue.SimpleQueue = queue.SimpleQueue()
+        self.threads: List[threading.Thread] = [
+            threading.Thread(target=self.work, name=f'{thread_name_prefix}_{ix}', daemon=True)
+            for ix in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            future, func, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, func: Callable, *args) -> Future:
+        future: Future = Future()
+        self.tasks.put((future, func, args))
+        return future
+
+    def shutdown(self, cancel_futures: bool=False):
+        if cancel_futures:
+            while True:
+                try:
+                    task = self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    task[0].cancel()
+        for _ in self.threads:
+            self.tasks.put(None)
+
+
+HEALTH_EWMA_ALPHA = 0.3
+HEALTH_FAILURE_THRESHOLD = 3
+HEALTH_COOLDOWN = 3600.
+HEALTH_MAX_COOLDOWN = 24 * 3600.
+HEDGE_MIN_DELAY = 0.5
+
+
+class SensorHealth:
+    # per-sensor pull outcomes kept across runs, a sensor failing
+    # HEALTH_FAILURE_THRESHOLD times in a row is skipped for a cool-down
+    # which doubles with every further failure
+    def __init__(self, path: Union[str, None]):
+        self.path: Union[str, None] = path
+        self.lock = threading.Lock()
+        self.sensors: Dict[str, Dict[str, Any]] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rt') as ifile:
+                    self.sensors = json.load(ifile)
+            except (OSError, ValueError) as e:
+                logging.warning(f'Ignoring unreadable health state {path}: {e}')
+
+    def state(self, sensor: str) -> Dict[str, Any]:
+        return self.sensors.setdefault(sensor, dict(
+            successes=0, failures=0, consecutive_failures=0, latency=None, open_until=0.))
+
+    def allow(self, sensor: str) -> bool:
+        with self.lock:
+            return time.time() >= self.state(sensor)['open_until']
+
+    def probing(self, sensor: str) -> bool:
+        # past its cool-down a broken sensor gets a single attempt, no retries
+        with self.lock:
+            return self.state(sensor)['consecutive_failures'] >= HEALTH_FAILURE_THRESHOLD
+
+    def hedge_delay(self, sensor: str, factor: float) -> Union[float, None]:
+        with self.lock:
+            latency: Union[float, None] = self.state(sensor)['latency']
+            if latency is None:
+                known: List[float] = [state['latency'] for state in self.sensors.values()
+                                      if state['latency'] is not None]
+                latency = statistics.median(known) if known else None
+        return None if latency is None else max(HEDGE_MIN_DELAY, factor * latency)
+
+    def success(self, sensor: str, latency: float):
+        with self.lock:
+            state: Dict[str, Any] = self.state(sensor)
+            state['successes'] += 1
+            state['consecutive_failures'] = 0
+            state['open_until'] = 0.
+            state['latency'] = latency if state['latency'] is None else \
+                HEALTH_EWMA_ALPHA * latency + (1 - HEALTH_EWMA_ALPHA) * state['latency']
+
+    def failure(self, sensor: str):
+        with self.lock:
+            state: Dict[str, Any] = self.state(sensor)
+            state['failures'] += 1
+            state['consecutive_failures'] += 1
+            self.open(sensor, state)
+
+    def trip(self, sensor: str):
+        # a sensor which does not exist is not going to come back on the next run
+        with self.lock:
+            state: Dict[str, Any] = self.state(sensor)
+            state['consecutive_failures'] = max(state['consecutive_failures'], HEALTH_FAILURE_THRESHOLD - 1)
+
+    def open(self, sensor: str, state: Dict[str, Any]):
+        excess: int = state['consecutive_failures'] - HEALTH_FAILURE_THRESHOLD
+        if excess < 0:
+            return
+        cooldown: float = min(HEALTH_COOLDOWN * 2 ** min(excess, 16), HEALTH_MAX_COOLDOWN)
+        state['open_until'] = time.time() + cooldown
+        logging.warning(f'Sensor {sensor} failed {state["consecutive_failures"]} times in a row, '
+                        f'skipping it for {cooldown:.0f}s.')
+
+    def success_rate(self, sensor: str) -> Union[float, None]:
+        with self.lock:
+            state: Dict[str, Any] = self.state(sensor)
+            total: int = state['successes'] + state['failures']
+            return state['successes'] / total if total else None
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            write_atomically(self.path, json.dumps(self.sensors))
+
+
+def pull_sensor_hedged(sensor: str, url: str, session: 'requests.Session',
+        timeout: float, deadline_at: Union[float, None],
+        cache: Union[JsonFileCache, None],
+        health: SensorHealth,
+        hedger: Union[DaemonThreadPool, None],
+        hedge_delay: Union[float, None],
+    ) -> Tuple[Union[Dict[str, str], None], float]:
+    # the outcome is recorded by the caller, which alone knows whether it beat the deadline
+    def attempt() -> Tuple[Union[Dict[str, str], None], float]:
+        started: float = time.monotonic()
+        params = pull_sensor(sensor, url, session, timeout, deadline_at, cache, health)
+        return params, time.monotonic() - started
+
+    if hedger is None or hedge_delay is None:
+        params, latency = attempt()
+    else:
+        pending: Set[Future] = {hedger.submit(attempt)}
+        done, pending = wait(pending, timeout=hedge_delay)
+        if pending:
+            # a slow answer, race it with a duplicate request and take whichever comes first
+            METRICS.count('hedges', sensor)
+            logging.info(f'Sensor {sensor} slower than {hedge_delay:.2f}s, sending a hedged request.')
+            pending.add(hedger.submit(attempt))
+        params, latency = None, 0.
+        while params is None and (done or pending):
+            if not done:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            future: Future = done.pop()
+            try:
+                params, latency = future.result()
+            except Exception as e:
+                logging.error(f'Processing measurements for sensor {sensor} failed: {e!r}')
+    return params, latency
+
+
+def pull_measurements(
+        retries: int,
+        timeout: int,
+        workers: int=8,
+        deadline: Union[float, None]=None,
+        session: Union['requests.Session', None]=None,
+        cache: Union[JsonFileCache, None]=None,
+        sensors: Union[Dict[str, str], None]=None,
+        health: Union[SensorHealth, None]=None,
+        hedge: float=0.,
+    ) -> Dict[str, Dict[str, str]]:
+    if sensors is None:
+        sensors = registry_sensors(load_sensor_registry(SENSOR_REGISTRY))
+    if health is not None:
+        for sensor in [sensor for sensor in sensors if not health.allow(sensor)]:
+            METRICS.count('circuit_open', sensor)
+            logging.info(f'Skipping sensor {sensor}, its circuit is open.')
+        sensors = {sensor: url for sensor, url in sensors.items() if health.allow(sensor)}
+    if not sensors:
+        return {}
+    workers = max(1, min(workers, len(sensors)))
+    session = session or requests_retry_session(retries=retries, pool_maxsize=workers)
+    meas: Dict[str, Dict[str, str]] = {}
+
+    deadline_at: Union[float, None] = None if deadline is None else time.monotonic() + deadline
+    executor = DaemonThreadPool(max_workers=workers, thread_name_prefix='pull')
+    futures: Dict[Future, str] = {}
+    hedger: Union[DaemonThreadPool, None] = None
+    if health is None:
+        futures = {
+            executor.submit(pull_sensor, sensor, url, session, timeout, deadline_at, cache): sensor
+            for sensor, url in sensors.items()}
+    else:
+        if hedge > 0:
+            hedger = DaemonThreadPool(max_workers=2 * workers, thread_name_prefix='hedge')
+        probe_session: Union['requests.Session', None] = None
+        for sensor, url in sensors.items():
+            sensor_session: 'requests.Session' = session
+            if health.probing(sensor):
+                probe_session = probe_session or requests_retry_session(retries=0, pool_maxsize=workers)
+                sensor_session = probe_session
+            futures[executor.submit(pull_sensor_hedged, sensor, url, sensor_session, timeout,
+                deadline_at, cache, health, hedger,
+                health.hedge_delay(sensor, hedge) if hedger else None)] = sensor
+    done, _ = wait(futures, timeout=deadline)
+    # stragglers are dropped, queued sensors are never started
+    executor.shutdown(cancel_futures=True)
+    if hedger is not None:
+        hedger.shutdown(cancel_futures=True)
+
+    # keep sensors order, the logs follow the registry; stragglers finish
+    # after this and must not count, every outcome is recorded here once
+    for future, sensor in futures.items():
+        if future not in done:
+            METRICS.count('deadline_misses', sensor)
+            logging.warning(f'Pulling measurements for sensor {sensor} missed the {deadline}s deadline.')
+            if health is not None:
+                health.failure(sensor)
             continue
+        try:
+            params = future.result()
+        except Exception as e:
+            logging.error(f'Processing measurements for sensor {sensor} failed: {e!r}')
+            if health is not None:
+                health.failure(sensor)
+            continue
+        if health is not None:
+            params, latency = params
+            if params:
+                health.success(sensor, latency)
+            else:
+                health.failure(sensor)
+        if params:
+            meas[sensor] = params
+    if cache is not None:
+        cache.save()
+    if health is not None:
+        health.save()
+    return meas
 
-        html: str = res.text
-        from lxml import etree
-        parser = etree.HTMLParser()
-        root = etree.fromstring(html, parser=parser)
-        maybe_address: etree._Element = root.find('.//td[@class="summary__address"]')#.text.strip()
-        if not hasattr(maybe_address, 'text'):
-            print(f"[!] Sensor {sensor} does not seem to exist. It is missing 'summary__address' class element.")
+
+CAPTURE_SUFFIXES = ('.html', '.htm')
+
+
+def iter_captures(source: str) -> Iterator[Tuple[str, float, bytes]]:
+    # pages are read one at a time, archives are never unpacked or seeked,
+    # a page was captured when it was last modified
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(CAPTURE_SUFFIXES):
+                    path: str = os.path.join(root, name)
+                    with open(path, 'rb') as ifile:
+                        yield os.path.relpath(path, source), os.fstat(ifile.fileno()).st_mtime, ifile.read()
+        return
+    with tarfile.open(source, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith(CAPTURE_SUFFIXES):
+                yield member.name, float(member.mtime), archive.extractfile(member).read()
+
+
+def decode_captures(batch: List[Tuple[str, float, bytes]]
+    ) -> List[Tuple[str, float, Union[str, None], Union[Dict[str, str], None]]]:
+    decoded: List[Tuple[str, float, Union[str, None], Union[Dict[str, str], None]]] = []
+    for name, timestamp, page in batch:
+        try:
+            address, _, paths = extract_widget([page])
+            numbers: List[Union[str, None]] = svg_paths_to_numbers(paths.values())
+        except Exception as e:
+            logging.error(f'Decoding capture {name} failed: {e!r}')
+            decoded.append((name, timestamp, None, None))
             continue
-        address: str = maybe_address.text.strip()
+        decoded.append((name, timestamp, address, {
+            key: number for key, number in zip(paths.keys(), numbers) if number is not None}))
+    return decoded
+
+
+def iter_batches(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    batch: List[Any] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-        m: List[etree._Element] = root.findall('.//div[@class="measurement"]')
 
-        if len(m) == 0:
-            logging.warning(f'Sensor {sensor} has no measurements.')
+def backfill_captures(source: str, workers: int, batch_size: int
+    ) -> Iterator[Tuple[str, float, Union[str, None], Union[Dict[str, str], None]]]:
+    # at most 2 * workers batches are in flight, results come out in archive order
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        inflight: deque = deque()
+        for batch in iter_batches(iter_captures(source), batch_size):
+            inflight.append(executor.submit(decode_captures, batch))
+            if len(inflight) >= 2 * workers:
+                yield from inflight.popleft().result()
+        while inflight:
+            yield from inflight.popleft().result()
+
+
+def write_backfill(
+        records: Iterable[Tuple[str, float, Union[str, None], Union[Dict[str, str], None]]],
+        ofile: io.TextIOBase,
+        fmt: str='csv',
+        history: Union['HistoryStore', None]=None,
+    ) -> Tuple[int, int]:
+    writer = csv.writer(ofile) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(('capture', 'timestamp', 'address') + HISTORY_KEYS)
+    ndecoded: int = 0
+    nfailed: int = 0
+    captures: List[Tuple[float, str, Dict[str, str]]] = []
+    for name, timestamp, address, params in records:
+        if address is None or not params:
+            nfailed += 1
+            logging.warning(f'Capture {name} holds no measurements.')
             continue
+        ndecoded += 1
+        if writer is not None:
+            writer.writerow((name, timestamp, address) + tuple(params.get(key, '') for key in HISTORY_KEYS))
+        else:
+            ofile.write(json.dumps(dict(capture=name, timestamp=timestamp, address=address, **params),
+                ensure_ascii=False) + '\n')
+        if history is not None:
+            # captures are laid out one directory per sensor, loose pages go by their address
+            sensor: str = os.path.basename(os.path.dirname(os.path.normpath(name))) or address
+            captures.append((timestamp, sensor, params))
+    if history is not None:
+        append_captures(history, captures)
+    return ndecoded, nfailed
 
-        #KEYS = set(('PM10', 'PM2.5', 'PM1', 'PRESSURE', 'HUMIDITY', 'TEMPERATURE', 'WIND_SPEED')) # API v1
-        KEYS = set(('PM10', 'PM2.5', 'PM1')) # API v2
-        measurement: etree._Element
-        for measurement in m:
-            name: str = measurement.find('.//h2[@class="measurement__name"]').text.strip()
-            value: etree._Element = measurement.find('.//div[@class="measurement__value"]')
-            path: str = value.find('.//path').attrib.get('d', '')
-            if name in KEYS:
-                params = meas.get(sensor, {})
-                params[name.lower()] = svg_path_to_number(path)
-                meas[sensor] = params
-            pass
-    return meas
+
+def append_captures(history: 'HistoryStore', captures: List[Tuple[float, str, Dict[str, str]]]):
+    # the store is scanned by bisection, records must not go back in time
+    latest: Union[float, None] = history.latest()
+    if latest is not None:
+        nstale: int = sum(1 for timestamp, _, _ in captures if timestamp <= latest)
+        if nstale:
+            logging.warning(f'Skipping {nstale} captures not newer than the history store.')
+        captures = [capture for capture in captures if capture[0] > latest]
+    captures.sort(key=lambda capture: capture[0])
+    for timestamp, group in itertools.groupby(captures, key=lambda capture: capture[0]):
+        history.append(timestamp, {sensor: params for _, sensor, params in group})
+
+
+# timestamp, sensor id, pm1, pm2.5, pm10 (NaN when not measured)
+HISTORY_RECORD = struct.Struct('<dIfff')
+HISTORY_KEYS = ('pm1', 'pm2.5', 'pm10')
+
+
+class HistoryStore:
+    # append-only array of fixed-width records ordered by time, sensor names
+    # live one per line in a side file and records refer to them by index
+    def __init__(self, path: str):
+        self.path: str = path
+        self.sensors_path: str = f'{path}.sensors'
+        self.sensors: List[str] = []
+        if os.path.exists(self.sensors_path):
+            with open(self.sensors_path, 'rt', encoding='utf-8') as ifile:
+                self.sensors = ifile.read().splitlines()
+        self.ids: Dict[str, int] = {name: ix for ix, name in enumerate(self.sensors)}
+
+    def sensor_id(self, sensor: str) -> int:
+        if sensor not in self.ids:
+            with open(self.sensors_path, 'at', encoding='utf-8') as ofile:
+                ofile.write(f'{sensor}\n')
+            self.ids[sensor] = len(self.sensors)
+            self.sensors.append(sensor)
+        return self.ids[sensor]
+
+    def append(self, timestamp: float, measurements: Dict[str, Dict[str, str]]):
+        def value(data: Dict[str, str], key: str) -> float:
+            try:
+                return float(data[key])
+            except (KeyError, ValueError):
+                return math.nan
+
+        records: bytes = b''.join(
+            HISTORY_RECORD.pack(timestamp, self.sensor_id(sensor), *(value(data, key) for key in HISTORY_KEYS))
+            for sensor, data in measurements.items())
+        with open(self.path, 'ab') as ofile:
+            # a torn record left by a crash would misalign everything after it
+            misaligned: int = ofile.tell() % HISTORY_RECORD.size
+            if misaligned:
+                ofile.truncate(ofile.tell() - misaligned)
+                ofile.seek(0, os.SEEK_END)
+            ofile.write(records)
+
+    def latest(self) -> Union[float, None]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as ifile:
+            nrecords: int = os.fstat(ifile.fileno()).st_size // HISTORY_RECORD.size
+            if not nrecords:
+                return None
+            ifile.seek((nrecords - 1) * HISTORY_RECORD.size)
+            (timestamp,) = struct.unpack('<d', ifile.read(8))
+        return timestamp
+
+    def scan(self,
+            since: Union[float, None]=None,
+            until: Union[float, None]=None,
+            sensor: Union[str, None]=None,
+        ) -> Iterator[Tuple[float, str, float, float, float]]:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HISTORY_RECORD.size:
+            return
+        if sensor is not None and sensor not in self.ids:
+            return
+        wanted: Union[int, None] = None if sensor is None else self.ids[sensor]
+
+        with open(self.path, 'rb') as ifile, \
+                mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            nrecords: int = len(view) // HISTORY_RECORD.size
+
+            def bisect_time(timestamp: float, right: bool) -> int:
+                lo, hi = 0, nrecords
+                while lo < hi:
+                    mid: int = (lo + hi) // 2
+                    (t,) = struct.unpack_from('<d', view, mid * HISTORY_RECORD.size)
+                    if t < timestamp or (right and t == timestamp):
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                return lo
+
+            first: int = 0 if since is None else bisect_time(since, right=False)
+            last: int = nrecords if until is None else bisect_time(until, right=True)
+            with memoryview(view)[first * HISTORY_RECORD.size:last * HISTORY_RECORD.size] as records:
+                for timestamp, sensor_id, pm1, pm25, pm10 in HISTORY_RECORD.iter_unpack(records):
+                    if wanted is None or sensor_id == wanted:
+                        yield timestamp, self.sensors[sensor_id], pm1, pm25, pm10
+
+    def averages(self,
+            since: Union[float, None]=None,
+            until: Union[float, None]=None,
+        ) -> Dict[str, Dict[str, float]]:
+        sums: Dict[str, List[float]] = {}
+        counts: Dict[str, List[int]] = {}
+        for _, sensor, *values in self.scan(since=since, until=until):
+            ssum: List[float] = sums.setdefault(sensor, [0.] * len(HISTORY_KEYS))
+            scount: List[int] = counts.setdefault(sensor, [0] * len(HISTORY_KEYS))
+            for ix, value in enumerate(values):
+                if not math.isnan(value):
+                    ssum[ix] += value
+                    scount[ix] += 1
+        return {sensor: {key: ssum[ix] / counts[sensor][ix]
+                         for ix, key in enumerate(HISTORY_KEYS) if counts[sensor][ix]}
+                for sensor, ssum in sums.items()}
+
+
+AQI_NAMES: List[str] = list(AQI_PM25_LEVELS.keys())
+AQI_PM25_BREAKPOINTS: List[float] = [d['hi'] for d in AQI_PM25_LEVELS.values()]
+# US EPA 24-hour PM10 breakpoints for the same categories
+AQI_PM10_BREAKPOINTS: List[float] = [54., 154., 254., 354., 424., 604.]
+
+
+def aqi_level(value: float, breakpoints: List[float]) -> int:
+    # first category whose upper bound is not below the value
+    return min(bisect.bisect_left(breakpoints, value), len(breakpoints) - 1)
 
 
 def aqi_by_pm25(pm25: float) -> str:
-    for name, d in AQI_PM25_LEVELS.items():
-        if pm25 <= d['hi']:
-            return name
-    return 'Hazardous'
+    return AQI_NAMES[aqi_level(pm25, AQI_PM25_BREAKPOINTS)]
+
+
+def aggregate(values: List[float], method: str='mean') -> float:
+    if method == 'mean':
+        return statistics.fmean(values)
+    elif method == 'median':
+        return statistics.median(values)
+    elif method == 'trimmed':
+        # drop the lowest and highest 10%, at least one of each past 2 values
+        ordered: List[float] = sorted(values)
+        cut: int = max(len(ordered) // 10, 1 if len(ordered) > 2 else 0)
+        return statistics.fmean(ordered[cut:len(ordered) - cut])
+    raise ValueError(f'Unknown aggregate {method}')
+
+
+def regional_aqi(
+        pm25: Dict[str, List[float]],
+        pm10: Union[Dict[str, List[float]], None]=None,
+        method: str='mean',
+    ) -> Dict[str, Dict[str, Any]]:
+    # the overall category of a region is the worse of its PM2.5 and PM10 ones
+    regions: Dict[str, Dict[str, Any]] = {}
+    for region, values in pm25.items():
+        if not values:
+            continue
+        level: Dict[str, Any] = {'pm2.5': aggregate(values, method)}
+        ix: int = aqi_level(level['pm2.5'], AQI_PM25_BREAKPOINTS)
+        if pm10 and pm10.get(region):
+            level['pm10'] = aggregate(pm10[region], method)
+            ix = max(ix, aqi_level(level['pm10'], AQI_PM10_BREAKPOINTS))
+        level['aqi'] = AQI_NAMES[ix]
+        regions[region] = level
+    return regions
+
+
+DEFAULT_REGION = 'Kraków'
+
+
+class FileStateStore:
+    # the aqi_status.txt/aqi_flag.txt pair of old, it only knows one region
+    def __init__(self, directory: str='.'):
+        self.status_path: str = os.path.join(directory, 'aqi_status.txt')
+        self.flag_path: str = os.path.join(directory, 'aqi_flag.txt')
+        self.lock = threading.Lock()
+
+    def alerts(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.status_path, 'rt') as ifile:
+                aqi: str = ifile.read().strip()
+            with open(self.flag_path, 'rt') as ifile:
+                bad: bool = bool(int(ifile.read().strip() or 0))
+        except (OSError, ValueError):
+            return {}
+        return {DEFAULT_REGION: dict(aqi=aqi, bad=bad, pm25=None, updated=os.path.getmtime(self.flag_path))}
+
+    def last_values(self, region: str) -> Dict[str, Dict[str, float]]:
+        return {}
+
+    def transition(self, region: str, aqi: str, bad: bool, pm25: float,
+            measurements: Dict[str, Dict[str, str]]) -> Union[bool, None]:
+        # another region would read and overwrite the state of this one
+        if region != DEFAULT_REGION:
+            raise ValueError(f'The file state store only keeps {DEFAULT_REGION}, not {region}.')
+        with self.lock:
+            former: Union[Dict[str, Any], None] = self.alerts().get(DEFAULT_REGION)
+            write_atomically(self.status_path, f'{aqi}')
+            write_atomically(self.flag_path, f'{int(bad)}')
+        return None if former is None else former['bad']
+
+
+class SqliteStateStore:
+    # alert state and last values per region, every transition is a single
+    # write transaction so concurrent runs see each other's alerts
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS alerts (
+            region TEXT PRIMARY KEY,
+            aqi TEXT NOT NULL,
+            bad INTEGER NOT NULL,
+            pm25 REAL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS last_values (
+            region TEXT NOT NULL,
+            sensor TEXT NOT NULL,
+            pm1 REAL,
+            pm25 REAL,
+            pm10 REAL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (region, sensor)
+        );
+    '''
+
+    def __init__(self, path: str):
+        self.path: str = path
+        with contextlib.closing(self.connect()) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(self.SCHEMA)
+
+    def connect(self):
+        import sqlite3
+
+        # autocommit mode, transactions are opened explicitly
+        db = sqlite3.connect(self.path, timeout=30., isolation_level=None)
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def alerts(self) -> Dict[str, Dict[str, Any]]:
+        with contextlib.closing(self.connect()) as db:
+            return {region: dict(aqi=aqi, bad=bool(bad), pm25=pm25, updated=updated)
+                    for region, aqi, bad, pm25, updated in db.execute(
+                        'SELECT region, aqi, bad, pm25, updated FROM alerts ORDER BY region')}
+
+    def last_values(self, region: str) -> Dict[str, Dict[str, float]]:
+        with contextlib.closing(self.connect()) as db:
+            return {sensor: {key: value for key, value in zip(HISTORY_KEYS, values) if value is not None}
+                    for sensor, *values in db.execute(
+                        'SELECT sensor, pm1, pm25, pm10 FROM last_values WHERE region = ? ORDER BY sensor',
+                        (region,))}
+
+    def transition(self, region: str, aqi: str, bad: bool, pm25: float,
+            measurements: Dict[str, Dict[str, str]]) -> Union[bool, None]:
+        def value(data: Dict[str, str], key: str) -> Union[float, None]:
+            try:
+                return float(data[key])
+            except (KeyError, ValueError):
+                return None
+
+        now: float = time.time()
+        with contextlib.closing(self.connect()) as db:
+            # take the write lock before reading, the former state cannot change under us
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT bad FROM alerts WHERE region = ?', (region,)).fetchone()
+                db.execute('INSERT OR REPLACE INTO alerts (region, aqi, bad, pm25, updated) '
+                           'VALUES (?, ?, ?, ?, ?)', (region, aqi, int(bad), pm25, now))
+                db.executemany('INSERT OR REPLACE INTO last_values (region, sensor, pm1, pm25, pm10, updated) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               [(region, sensor, *(value(data, key) for key in HISTORY_KEYS), now)
+                                for sensor, data in measurements.items()])
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return None if row is None else bool(row[0])
+
+
+STATE_BACKENDS = {
+    'sqlite': SqliteStateStore,
+    'file': FileStateStore,
+}
+
+
+def open_state_store(spec: str, regions: Iterable[str]=()) -> Union[SqliteStateStore, FileStateStore]:
+    # BACKEND:PATH, a bare path is an SQLite database
+    backend, _, path = spec.partition(':')
+    if backend not in STATE_BACKENDS or not path:
+        backend, path = 'sqlite', spec
+    others: List[str] = [region for region in regions if region != DEFAULT_REGION]
+    if backend == 'file' and others:
+        raise ValueError(f'The file state store only keeps {DEFAULT_REGION}, '
+                         f'use an sqlite one for {", ".join(others)}.')
+    return STATE_BACKENDS[backend](path)
+
+
+class Destination:
+    # a Mastodon account alerts are posted to, rate limits are tracked per
+    # account from the X-RateLimit-* headers of every response
+    def __init__(self, name: str, host: str, token: str, region: Union[str, None]=None):
+        self.name: str = name
+        self.host: str = host.rstrip('/')
+        self.token: str = token
+        # None posts alerts of every region
+        self.region: Union[str, None] = region
+        self.session: Union['requests.Session', None] = None
+        self.lock = threading.Lock()
+        self.remaining: Union[int, None] = None
+        self.reset_at: float = 0.
+
+    def ready_at(self) -> float:
+        with self.lock:
+            if self.remaining is not None and self.remaining <= 0:
+                return self.reset_at
+            return 0.
+
+    def update_limits(self, res: 'requests.Response'):
+        remaining: Union[str, None] = res.headers.get('X-RateLimit-Remaining')
+        reset: Union[str, None] = res.headers.get('X-RateLimit-Reset')
+        with self.lock:
+            if remaining is not None and remaining.isdigit():
+                self.remaining = int(remaining)
+            elif res.status_code == 429:
+                self.remaining = 0
+            if reset:
+                try:
+                    self.reset_at = datetime.fromisoformat(reset.replace('Z', '+00:00')).timestamp()
+                except ValueError:
+                    logging.warning(f'Unparsable X-RateLimit-Reset from {self.name}: {reset}')
+            elif res.status_code == 429:
+                retry_after: str = res.headers.get('Retry-After', '')
+                self.reset_at = time.time() + (float(retry_after) if retry_after.isdigit() else POST_BACKOFF)
+
+
+def load_destinations(path: Union[str, None]) -> List[Destination]:
+    # without a destinations file alerts go to the SERVER/TOKEN account
+    if not path:
+        return [Destination('default', os.environ['SERVER'], os.environ['TOKEN'])]
+    with open(path, 'rt', encoding='utf-8') as ifile:
+        entries: List[Dict[str, str]] = json.load(ifile)
+    destinations: List[Destination] = []
+    for ix, entry in enumerate(entries):
+        # tokens are best kept out of the file, token_env names the variable holding it
+        token: str = entry['token'] if 'token' in entry else os.environ[entry['token_env']]
+        destinations.append(Destination(entry.get('name', f'{ix}'), entry['host'], token, entry.get('region')))
+    if len({destination.name for destination in destinations}) != len(destinations):
+        raise ValueError(f'Duplicate destination names in {path}')
+    return destinations
 
 
 def status_post(status: str, media_ids: List[str],
-        session: requests.Session, timeout: int
-    ) -> Tuple[bool, Union[requests.Response, None]]:
-    url: str = f'{MASTODON_HOST}/api/v1/statuses'
+        destination: Destination, timeout: int,
+        idempotency_key: Union[str, None]=None,
+    ) -> Tuple[bool, Union['requests.Response', None]]:
+    import requests
+
+    url: str = f'{destination.host}/api/v1/statuses'
     data = {
         'status': status,
         'media_ids[]': media_ids,
     }
+    headers: Dict[str, str] = dict(Authorization=f'Bearer {destination.token}')
+    if idempotency_key:
+        # a retried post is not published twice
+        headers['Idempotency-Key'] = idempotency_key
     try:
-        res: requests.Response = session.post(url, timeout=timeout,
-            data=data, headers=dict(Authorization=f'Bearer {MASTODON_TOKEN}'))
+        with METRICS.timer('status_post', destination.name):
+            res: requests.Response = destination.session.post(url, timeout=timeout,
+                data=data, headers=headers)
+        METRICS.record_response('status_post', destination.name, res)
+        destination.update_limits(res)
 
         if res.status_code < 200 or 300 <= res.status_code:
-            logging.error(f'Http error: status={res.status_code}')
+            logging.error(f'Http error: status={res.status_code} destination={destination.name}')
             return False, res
 
         return True, res
@@ -295,29 +1513,35 @@ def status_post(status: str, media_ids: List[str],
         logging.error(f"Network timeout failure: {e}")
     except requests.exceptions.RequestException as e:
         logging.error(f"Core requests failure: {e}")
+    METRICS.record_response('status_post', destination.name, None)
     return False, None
 
 
 def attach_media(path: str, description: str,
-        session: requests.Session, timeout: int
-    ) -> Tuple[bool, Union[requests.Response, None]]:
-    url: str = f'{MASTODON_HOST}/api/v1/media'
+        destination: Destination, timeout: int
+    ) -> Tuple[bool, Union['requests.Response', None]]:
+    import requests
+
+    url: str = f'{destination.host}/api/v1/media'
     data = {
         'description': description,
     }
     files = {
         'file': (
             os.path.basename(path),
-            Path(path).open('rb'),
+            Path(path).read_bytes(),
             'application/octet-stream'
         )
     }
     try:
-        res: requests.Response = session.post(url, timeout=timeout,
-            data=data, files=files, headers=dict(Authorization=f'Bearer {MASTODON_TOKEN}'))
+        with METRICS.timer('media_upload', destination.name):
+            res: requests.Response = destination.session.post(url, timeout=timeout,
+                data=data, files=files, headers=dict(Authorization=f'Bearer {destination.token}'))
+        METRICS.record_response('media_upload', destination.name, res)
+        destination.update_limits(res)
 
         if res.status_code < 200 or 300 <= res.status_code:
-            logging.error(f'Http error: status={res.status_code}')
+            logging.error(f'Http error: status={res.status_code} destination={destination.name}')
             return False, res
 
         return True, res
@@ -329,81 +1553,524 @@ def attach_media(path: str, description: str,
         logging.error(f"Network timeout failure: {e}")
     except requests.exceptions.RequestException as e:
         logging.error(f"Core requests failure: {e}")
+    METRICS.record_response('media_upload', destination.name, None)
     return False, None
 
 
-def push_aqi_status(
-        measurements: Dict[str, Dict[str, str]],
-        former_bad_aqi: Union[bool, None],
-        retries=3,
-        timeout=5,
-    ):
-    pm25: List[float] = [float(data['pm2.5'])for _, data in measurements.items() if 'pm2.5' in data]
-    logging.info(f'PM2.5 concentrations: {pm25}')
-    pm25 = pm25[:3]
-    if len(pm25) == 0:
-        logging.error(f'Not a single one PM2.5 measurement was found retrieved data. {measurements}')
-        return
-    pm25_avg: float = sum(pm25) / len(pm25)
-    aqi: str = aqi_by_pm25(pm25_avg)
+# Mastodon removes uploads which were not attached to a status within a day
+MEDIA_CACHE_TTL: float = 20 * 3600.
 
-    bad_aqi_flag: bool = aqi != 'Good'
-    with open('aqi_status.txt', 'wt') as ofile:
-        ofile.write(f'{aqi}')
-    with open('aqi_flag.txt', 'wt') as ofile:
-        ofile.write(f'{int(bad_aqi_flag)}')
 
-    send_flag: bool = (former_bad_aqi is None) or (bad_aqi_flag) or (not bad_aqi_flag and former_bad_aqi)
-    if not send_flag:
-        return
+def media_cache_key(destination: Destination, region: str, path: str, description: str) -> str:
+    # an upload belongs to the account which made it, and is staged for one region's next alert
+    digest: str = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    return f'{destination.host}|{destination.name}|{region}|{digest}|{description}'
+
+
+def upload_media(path: str, description: str,
+        destination: Destination, timeout: int
+    ) -> Union[str, None]:
+    ok, res = attach_media(path, description, destination=destination, timeout=timeout)
+    if not ok:
+        return None
+    return res.json().get('id', '') or None
+
 
+def compose_status(aqi: str, pm25_avg: float, bad_aqi_flag: bool, region: str=DEFAULT_REGION,
+        pm10_avg: Union[float, None]=None) -> str:
+    levels: str = f"PM2.5 level is {pm25_avg:.0f} μg/m³"
+    if pm10_avg is not None:
+        levels += f", PM10 level is {pm10_avg:.0f} μg/m³"
     if bad_aqi_flag:
         status: str = (
-            f"Kraków bad air quality alert ⚠ {aqi.upper()}\n\n"
-            f"PM2.5 level is {pm25_avg:.0f} μg/m³"
+            f"{region} bad air quality alert ⚠ {aqi.upper()}\n\n"
+            f"{levels}"
         )
         if AQI_PM25_LEVELS[aqi]['regular']:
             status += f"\n\n{AQI_PM25_LEVELS[aqi]['regular']}"
         if AQI_PM25_LEVELS[aqi]['sensitive']:
             status += f"\n\n{AQI_PM25_LEVELS[aqi]['sensitive']}"
-        status += "\n\n#SMOG #KRAKÓW #KrakówSmog"
+        tag: str = region.replace(' ', '')
+        status += f"\n\n#SMOG #{tag.upper()} #{tag}Smog"
         pass
     else:
-        status: str = f"Kraków air quality is back to normal. 🍃\n\nPM2.5 level is {pm25_avg:.0f} μg/m³"
+        status: str = f"{region} air quality is back to normal. 🍃\n\n{levels}"
+    return status
 
-    session: requests.Session = requests_retry_session(retries=retries)
 
-    ok, res = attach_media(AQI_PM25_LEVELS[aqi]['img'], aqi, session=session, timeout=timeout)
-    if ok:
-        media_id = res.json().get('id', '')
-        logging.info(f'Attaching media_id={media_id}')
-        media_ids = [media_id]
-    else:
-        media_ids = []
-    ok, res = status_post(status, media_ids, session=session, timeout=timeout)
-    if ok:
-        logging.info(f'Status POST: {res.json()}')
-    return
-
-
-def main(
-    test_chars: ("Test character recognition", "flag", "tc"),
-    test_nums: ("Test number recognition", "flag", "tn"),
-    report: ("Report live values", "flag", "R"),
-    retries: ("Number of HTTP(s) retries.", "option", 'r', int)=5,
-    timeout: ("HTTP(s) timeout, in seconds.", "option", 't', int)=5,
-    former_aqi: ("Previous AQI status, False=good, True=polluted.", 'positional', None, int)=None,
+POST_WORKERS = 16
+POST_ATTEMPTS = 5
+POST_BACKOFF = 1.
+# a destination limited for longer than this is given up on for this alert
+POST_MAX_DELAY = 120.
+POST_RETRY_QUEUE = 256
+
+
+def retry_at(destination: Destination, res: Union['requests.Response', None]) -> Union[float, None]:
+    # connection failures, rate limits and server errors are worth another
+    # attempt, any other client error is not going to change
+    if res is None or 500 <= res.status_code:
+        return time.time()
+    if res.status_code == 429:
+        return max(destination.ready_at(), time.time())
+    return None
+
+
+def fan_out(
+        destinations: List[Destination],
+        deliver: Callable[[Destination], Tuple[bool, Union[float, None]]],
+        workers: int=POST_WORKERS,
+        attempts: int=POST_ATTEMPTS,
+        backoff: float=POST_BACKOFF,
+    ) -> Dict[str, bool]:
+    # deliveries are scheduled from a heap ordered by the time a destination
+    # is ready again, rate limited destinations wait for their reset instead
+    # of being retried blindly
+    delivered: Dict[str, bool] = {}
+    queue: List[Tuple[float, int, int, Destination]] = [
+        (destination.ready_at(), seq, 0, destination) for seq, destination in enumerate(destinations)]
+    heapq.heapify(queue)
+    seq: int = len(queue)
+    running: Dict[Future, Tuple[int, Destination]] = {}
+    workers = max(1, min(workers, len(destinations)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='post')
+    try:
+        while queue or running:
+            now: float = time.time()
+            while queue and queue[0][0] <= now and len(running) < workers:
+                _, _, attempt, destination = heapq.heappop(queue)
+                running[executor.submit(deliver, destination)] = (attempt, destination)
+            timeout: Union[float, None] = None
+            if queue and len(running) < workers:
+                timeout = max(0., queue[0][0] - now)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt, destination = running.pop(future)
+                try:
+                    ok, ready = future.result()
+                except Exception as e:
+                    logging.error(f'Posting to {destination.name} failed: {e!r}')
+                    ok, ready = False, None
+                if ok:
+                    delivered[destination.name] = True
+                    continue
+                now = time.time()
+                ready = None if ready is None else max(ready, now + backoff * 2 ** attempt)
+                if ready is None or attempt + 1 >= attempts or ready - now > POST_MAX_DELAY \
+                        or len(queue) >= POST_RETRY_QUEUE:
+                    METRICS.count('post_failures', destination.name)
+                    logging.error(f'Giving up posting to {destination.name} after {attempt + 1} attempt(s).')
+                    delivered[destination.name] = False
+                    continue
+                METRICS.count('post_retries', destination.name)
+                logging.info(f'Retrying post to {destination.name} in {ready - now:.1f}s.')
+                heapq.heappush(queue, (ready, seq, attempt + 1, destination))
+                seq += 1
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return delivered
+
+
+def stage_media(staged: List[Tuple[Destination, str, str, str]], media_cache: JsonFileCache, timeout: int):
+    # destination, region, picture and its description of every delivered alert
+    def upload(entry: Tuple[Destination, str, str, str]) -> Union[str, None]:
+        destination, _, path, description = entry
+        try:
+            return upload_media(path, description, destination=destination, timeout=timeout)
+        except Exception as e:
+            logging.error(f'Staging media for {destination.name} failed: {e!r}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(POST_WORKERS, len(staged))),
+            thread_name_prefix='stage') as executor:
+        for entry, media_id in zip(staged, executor.map(upload, staged)):
+            if media_id:
+                media_cache.put(media_cache_key(*entry), dict(id=media_id))
+    media_cache.save()
+
+
+def start_staging(staged: List[Tuple[Destination, str, str, str]], media_cache: JsonFileCache, timeout: int):
+    # the next alerts attach pictures uploaded now, in the background so they
+    # hold no posting worker; not a daemon thread, a run waits for it to finish
+    if staged:
+        threading.Thread(target=stage_media, args=(staged, media_cache, timeout), name='stage-media').start()
+
+
+def push_aqi_status(
+        measurements: Dict[str, Dict[str, str]],
+        state: Union[SqliteStateStore, FileStateStore],
+        destinations: List[Destination],
+        region: str=DEFAULT_REGION,
+        retries=3,
+        timeout=5,
+        media_cache: Union[JsonFileCache, None]=None,
+        method: str='mean',
+        level: Union[Dict[str, Any], None]=None,
+        staged: Union[List[Tuple[Destination, str, str, str]], None]=None,
+    ) -> Union[bool, None]:
+    if level is None:
+        pm25: List[float] = [float(data['pm2.5'])for _, data in measurements.items() if 'pm2.5' in data]
+        pm10: List[float] = [float(data['pm10']) for _, data in measurements.items() if 'pm10' in data]
+        logging.info(f'PM2.5 concentrations: {pm25}, PM10 concentrations: {pm10}')
+        level = regional_aqi({region: pm25}, {region: pm10}, method=method).get(region)
+    if level is None:
+        logging.error(f'Not a single one PM2.5 measurement was found retrieved data. {measurements}')
+        return
+    pm25_avg: float = level['pm2.5']
+    aqi: str = level['aqi']
+
+    bad_aqi_flag: bool = aqi != 'Good'
+    former_bad_aqi: Union[bool, None] = state.transition(region, aqi, bad_aqi_flag, pm25_avg, measurements)
+
+    send_flag: bool = (former_bad_aqi is None) or (bad_aqi_flag) or (not bad_aqi_flag and former_bad_aqi)
+    destinations = [destination for destination in destinations if destination.region in (None, region)]
+    if not send_flag or not destinations:
+        return bad_aqi_flag
+
+    # destinations on the same host share a pool of keep-alive connections
+    sessions: Dict[str, 'requests.Session'] = {
+        destination.host: destination.session for destination in destinations if destination.session}
+    for destination in destinations:
+        if destination.session is None:
+            destination.session = sessions.setdefault(destination.host,
+                requests_retry_session(retries=retries, pool_maxsize=POST_WORKERS))
+
+    img: str = AQI_PM25_LEVELS[aqi]['img']
+    status: str = compose_status(aqi, pm25_avg, bad_aqi_flag, region, level.get('pm10'))
+    alert_id: str = uuid.uuid4().hex
+    # uploads which made it before a failed post are attached on the next attempt
+    uploads: Dict[str, str] = {}
+
+    def deliver(destination: Destination) -> Tuple[bool, Union[float, None]]:
+        if destination.ready_at() > time.time():
+            return False, destination.ready_at()
+        # the post needs the media id, so a fresh upload has nothing to overlap
+        # with, an upload staged by the previous alert is what saves the round trip
+        key: str = media_cache_key(destination, region, img, aqi)
+        cached: Union[Dict[str, Any], None] = None
+        if destination.name in uploads:
+            cached = dict(id=uploads[destination.name])
+        elif media_cache is not None:
+            cached = media_cache.get(key)
+
+        media_id: Union[str, None] = None
+        if cached is not None:
+            media_id = cached['id']
+        else:
+            ok, res = attach_media(img, aqi, destination=destination, timeout=timeout)
+            if ok:
+                media_id = uploads[destination.name] = res.json().get('id', '') or None
+            elif retry_at(destination, res) is not None:
+                return False, retry_at(destination, res)
+        if media_id:
+            logging.info(f'Attaching media_id={media_id} for {destination.name}')
+        idempotency_key: str = f'{alert_id}-{destination.name}'
+        ok, res = status_post(status, [media_id] if media_id else [], destination=destination,
+            timeout=timeout, idempotency_key=idempotency_key)
+
+        if not ok and cached is not None and res is not None and 400 <= res.status_code < 500 \
+                and res.status_code != 429:
+            logging.warning(f'Cached media_id={media_id} was rejected, uploading it again.')
+            uploads.pop(destination.name, None)
+            media_id = upload_media(img, aqi, destination=destination, timeout=timeout)
+            ok, res = status_post(status, [media_id] if media_id else [], destination=destination,
+                timeout=timeout, idempotency_key=f'{idempotency_key}-media')
+        if not ok:
+            return False, retry_at(destination, res)
+        logging.info(f'Status POST to {destination.name}: {res.json()}')
+
+        if media_cache is not None:
+            # an attached upload cannot be reused
+            media_cache.invalidate(key)
+        return True, None
+
+    delivered: Dict[str, bool] = fan_out(destinations, deliver)
+    logging.info(f'{region} alert delivered to {sum(delivered.values())} of {len(destinations)} destination(s).')
+    if media_cache is not None:
+        media_cache.save()
+        # a caller pushing several regions stages once all of them are out
+        entries: List[Tuple[Destination, str, str, str]] = [
+            (destination, region, img, aqi) for destination in destinations
+            if bad_aqi_flag and delivered.get(destination.name)]
+        if staged is not None:
+            staged.extend(entries)
+        else:
+            start_staging(entries, media_cache, timeout)
+    return bad_aqi_flag
+
+
+def push_regions(
+        measurements: Dict[str, Dict[str, str]],
+        sensor_registry: Dict[str, Dict[str, str]],
+        state: Union[SqliteStateStore, FileStateStore],
+        destinations: List[Destination],
+        retries=3,
+        timeout=5,
+        media_cache: Union[JsonFileCache, None]=None,
+        method: str='mean',
+    ) -> Dict[str, Union[bool, None]]:
+    # every region has its own alert state, its status is computed from its own sensors
+    def concentrations(sensors: Iterable[str], key: str) -> List[float]:
+        return [float(measurements[sensor][key]) for sensor in sensors
+                if sensor in measurements and key in measurements[sensor]]
+
+    levels: Dict[str, Dict[str, Any]] = regional_aqi(
+        {region: concentrations(sensors, 'pm2.5') for region, sensors in sensor_registry.items()},
+        {region: concentrations(sensors, 'pm10') for region, sensors in sensor_registry.items()},
+        method=method)
+    flags: Dict[str, Union[bool, None]] = {}
+    staged: List[Tuple[Destination, str, str, str]] = []
+    for region, sensors in sensor_registry.items():
+        region_measurements: Dict[str, Dict[str, str]] = {
+            sensor: measurements[sensor] for sensor in sensors if sensor in measurements}
+        if not region_measurements:
+            logging.error(f'No measurements were retrieved for region {region}.')
+            continue
+        if region not in levels:
+            logging.error(f'Not a single one PM2.5 measurement was found for region {region}. {region_measurements}')
+            continue
+        logging.info(f'{region} levels: {levels[region]}')
+        flags[region] = push_aqi_status(region_measurements, state=state, destinations=destinations,
+            region=region, retries=retries, timeout=timeout, media_cache=media_cache, method=method,
+            level=levels[region], staged=staged)
+    if media_cache is not None:
+        start_staging(staged, media_cache, timeout)
+    return flags
+
+
+def run_daemon(
+        interval: float,
+        state: Union[SqliteStateStore, FileStateStore],
+        destinations: List[Destination],
+        retries: int,
+        timeout: int,
+        workers: int,
+        deadline: Union[float, None],
+        cache: Union[JsonFileCache, None]=None,
+        media_cache: Union[JsonFileCache, None]=None,
+        metrics_prom: Union[str, None]=None,
+        metrics_json: Union[str, None]=None,
+        history: Union[HistoryStore, None]=None,
+        method: str='mean',
+        sensor_registry: Union[Dict[str, Dict[str, str]], None]=None,
+        health: Union[SensorHealth, None]=None,
+        hedge: float=0.,
     ):
+    stop = threading.Event()
+    sensor_registry = sensor_registry or load_sensor_registry(SENSOR_REGISTRY)
 
-    former_aqi = bool(former_aqi)
-    logging.basicConfig(level=logging.INFO)
+    def on_signal(signum: int, _frame):
+        logging.info(f'Received signal {signum}, shutting down.')
+        stop.set()
 
-    if test_chars:
-        test_character_recognition()
-    elif test_nums:
-        test_number_recognition()
-    elif report:
-        measurements = pull_measurements(retries=retries, timeout=timeout)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    # keep-alive sessions live as long as the daemon, one for airly.org and
+    # one per Mastodon host kept by the destinations
+    session: requests.Session = requests_retry_session(retries=retries, pool_maxsize=workers)
+    with session:
+        while not stop.is_set():
+            started: float = time.monotonic()
+            METRICS.reset()
+            with METRICS.timer('pull'):
+                measurements = pull_measurements(retries=retries, timeout=timeout,
+                    workers=workers, deadline=deadline, session=session, cache=cache,
+                    sensors=registry_sensors(sensor_registry), health=health, hedge=hedge)
+            if history is not None:
+                history.append(time.time(), measurements)
+            with METRICS.timer('push'):
+                push_regions(measurements, sensor_registry, state=state,
+                    destinations=destinations, retries=retries, timeout=timeout,
+                    media_cache=media_cache, method=method)
+            export_metrics(metrics_prom, metrics_json)
+            stop.wait(max(0., interval - (time.monotonic() - started)))
+    for destination_session in {id(d.session): d.session for d in destinations if d.session}.values():
+        destination_session.close()
+    logging.info('Daemon stopped.')
+
+
+def select_sensors(registry: str, shard: Union[str, None]) -> Union[Dict[str, Dict[str, str]], None]:
+    sensor_registry: Dict[str, Dict[str, str]] = load_sensor_registry(registry)
+    if shard:
+        index, _, count = shard.partition('/')
+        if not (index.isdigit() and count.isdigit() and int(index) < int(count)):
+            logging.error(f'Shard {shard} is not INDEX/COUNT with 0 <= INDEX < COUNT.')
+            return None
+        sensor_registry = shard_sensor_registry(sensor_registry, int(index), int(count))
+    return sensor_registry
+
+
+def acquire_measurements(
+        sensor_registry: Dict[str, Dict[str, str]],
+        retries: int,
+        timeout: int,
+        workers: int,
+        deadline: Union[float, None],
+        cache: Union[JsonFileCache, None]=None,
+        history: Union[HistoryStore, None]=None,
+        output: Union[str, None]=None,
+        merge: Union[str, None]=None,
+        health: Union[SensorHealth, None]=None,
+        hedge: float=0.,
+    ) -> Dict[str, Dict[str, str]]:
+    if merge:
+        return merge_measurements(merge.split(','), sensor_registry)
+    with METRICS.timer('pull'):
+        measurements = pull_measurements(retries=retries, timeout=timeout,
+            workers=workers, deadline=deadline, cache=cache,
+            sensors=registry_sensors(sensor_registry), health=health, hedge=hedge)
+    if history is not None:
+        history.append(time.time(), measurements)
+    if output:
+        write_atomically(output, json.dumps(measurements, ensure_ascii=False))
+    return measurements
+
+
+# command line options shared by the subcommands
+OPT_RETRIES = ("Number of HTTP(s) retries.", "option", 'r', int)
+OPT_TIMEOUT = ("HTTP(s) timeout, in seconds.", "option", 't', int)
+OPT_WORKERS = ("Number of sensors pulled concurrently.", "option", 'w', int)
+OPT_DEADLINE = ("Run-wide deadline for pulling all sensors, in seconds.", "option", 'd', float)
+OPT_CACHE = ("Widget cache file, pages which did not change are not parsed again.", "option", 'c')
+OPT_CACHE_TTL = ("Widget cache entries lifetime, in seconds.", "option", 'ct', float)
+OPT_MEDIA_CACHE = ("Media cache file, pre-uploaded pictures are reused by the next alert.", "option", 'mc')
+OPT_METRICS_PROM = ("Prometheus textfile to export run metrics to.", "option", 'mp')
+OPT_METRICS_JSON = ("JSON file to export run summary to.", "option", 'mj')
+OPT_HISTORY = ("Measurement history file, every pull is appended to it.", "option", 'H')
+OPT_METHOD = ("How PM2.5 readings are aggregated.", "option", 'a', str, ['mean', 'median', 'trimmed'])
+OPT_REGISTRY = ("Sensor registry file.", "option", 'S')
+OPT_SHARD = ("Pull only the given shard of the registry, as INDEX/COUNT, push then only writes it to --output.", "option", 'sh')
+OPT_OUTPUT = ("JSON file to write pulled measurements to, e.g. for merging shards.", "option", 'o')
+OPT_MERGE = ("Comma separated JSON files with shard measurements to use instead of pulling.", "option", 'm')
+OPT_HEALTH = ("Sensor health file, failing sensors are skipped for a cool-down.", "option", 'hf')
+OPT_HEDGE = ("Send a duplicate request for sensors this many times slower than usual, 0 disables.", "option", 'hg', float)
+OPT_DESTINATIONS = ("JSON list of Mastodon accounts to post to, SERVER/TOKEN account when not given.", "option", 'ds')
+OPT_STATE = ("Alert state store, as BACKEND:PATH with sqlite or file (single region) backend, a bare path is SQLite.", "option", 'st')
+STATE_DEFAULT = 'aqi_state.db'
+
+
+class Commands:
+    commands = 'push', 'daemon', 'report', 'alerts', 'averages', 'backfill', 'test_chars', 'test_nums', 'test_history', 'test_state', 'test_fan_out', 'test_startup'
+
+    def push(self,
+        retries: OPT_RETRIES=5,
+        timeout: OPT_TIMEOUT=5,
+        workers: OPT_WORKERS=8,
+        deadline: OPT_DEADLINE=None,
+        cache: OPT_CACHE=None,
+        cache_ttl: OPT_CACHE_TTL=6 * 3600.,
+        media_cache: OPT_MEDIA_CACHE=None,
+        metrics_prom: OPT_METRICS_PROM=None,
+        metrics_json: OPT_METRICS_JSON=None,
+        history: OPT_HISTORY=None,
+        method: OPT_METHOD='mean',
+        registry: OPT_REGISTRY=SENSOR_REGISTRY,
+        shard: OPT_SHARD=None,
+        output: OPT_OUTPUT=None,
+        merge: OPT_MERGE=None,
+        health: OPT_HEALTH=None,
+        hedge: OPT_HEDGE=0.,
+        destinations: OPT_DESTINATIONS=None,
+        state: OPT_STATE=STATE_DEFAULT,
+        ):
+        "Pull live values and push the AQI status"
+        # a shard sees a part of every region, its alerts would be wrong
+        if shard and not output:
+            logging.error('A shard only collects measurements, --output is required, push them with --merge.')
+            return os.EX_USAGE
+        sensor_registry: Union[Dict[str, Dict[str, str]], None] = select_sensors(registry, shard)
+        if sensor_registry is None:
+            return os.EX_USAGE
+        # shards post nothing and need no accounts nor state
+        accounts: List[Destination] = [] if shard else load_destinations(destinations)
+        try:
+            store = None if shard else open_state_store(state, sensor_registry)
+        except ValueError as e:
+            logging.error(f'Unusable state store: {e}')
+            return os.EX_USAGE
+        METRICS.enabled = bool(metrics_prom or metrics_json)
+        measurements = acquire_measurements(sensor_registry,
+            retries=retries, timeout=timeout, workers=workers, deadline=deadline,
+            cache=JsonFileCache(cache, ttl=cache_ttl) if cache else None,
+            history=HistoryStore(history) if history else None,
+            output=output, merge=merge, health=SensorHealth(health), hedge=hedge)
+        if shard:
+            export_metrics(metrics_prom, metrics_json)
+            return os.EX_OK
+        with METRICS.timer('push'):
+            push_regions(measurements, sensor_registry, state=store, destinations=accounts,
+                retries=retries, timeout=timeout, method=method,
+                media_cache=JsonFileCache(media_cache, ttl=MEDIA_CACHE_TTL) if media_cache else None)
+        export_metrics(metrics_prom, metrics_json)
+        return os.EX_OK
+
+    def daemon(self,
+        interval: ("Polling interval, in seconds.", "option", 'i', float)=3600.,
+        retries: OPT_RETRIES=5,
+        timeout: OPT_TIMEOUT=5,
+        workers: OPT_WORKERS=8,
+        deadline: OPT_DEADLINE=None,
+        cache: OPT_CACHE=None,
+        cache_ttl: OPT_CACHE_TTL=6 * 3600.,
+        media_cache: OPT_MEDIA_CACHE=None,
+        metrics_prom: OPT_METRICS_PROM=None,
+        metrics_json: OPT_METRICS_JSON=None,
+        history: OPT_HISTORY=None,
+        method: OPT_METHOD='mean',
+        registry: OPT_REGISTRY=SENSOR_REGISTRY,
+        health: OPT_HEALTH=None,
+        hedge: OPT_HEDGE=0.,
+        destinations: OPT_DESTINATIONS=None,
+        state: OPT_STATE=STATE_DEFAULT,
+        ):
+        "Keep running, pull and push every interval"
+        sensor_registry: Dict[str, Dict[str, str]] = load_sensor_registry(registry)
+        try:
+            store = open_state_store(state, sensor_registry)
+        except ValueError as e:
+            logging.error(f'Unusable state store: {e}')
+            return os.EX_USAGE
+        accounts: List[Destination] = load_destinations(destinations)
+        METRICS.enabled = bool(metrics_prom or metrics_json)
+        run_daemon(interval, state=store, destinations=accounts, retries=retries,
+            timeout=timeout, workers=workers, deadline=deadline,
+            cache=JsonFileCache(cache, ttl=cache_ttl) if cache else None,
+            media_cache=JsonFileCache(media_cache, ttl=MEDIA_CACHE_TTL) if media_cache else None,
+            metrics_prom=metrics_prom, metrics_json=metrics_json,
+            history=HistoryStore(history) if history else None, method=method,
+            sensor_registry=sensor_registry,
+            health=SensorHealth(health), hedge=hedge)
+        return os.EX_OK
+
+    def report(self,
+        retries: OPT_RETRIES=5,
+        timeout: OPT_TIMEOUT=5,
+        workers: OPT_WORKERS=8,
+        deadline: OPT_DEADLINE=None,
+        cache: OPT_CACHE=None,
+        cache_ttl: OPT_CACHE_TTL=6 * 3600.,
+        metrics_prom: OPT_METRICS_PROM=None,
+        metrics_json: OPT_METRICS_JSON=None,
+        history: OPT_HISTORY=None,
+        registry: OPT_REGISTRY=SENSOR_REGISTRY,
+        shard: OPT_SHARD=None,
+        output: OPT_OUTPUT=None,
+        merge: OPT_MERGE=None,
+        health: OPT_HEALTH=None,
+        hedge: OPT_HEDGE=0.,
+        ):
+        "Report live values"
+        sensor_registry: Union[Dict[str, Dict[str, str]], None] = select_sensors(registry, shard)
+        if sensor_registry is None:
+            return os.EX_USAGE
+        METRICS.enabled = bool(metrics_prom or metrics_json)
+        measurements = acquire_measurements(sensor_registry,
+            retries=retries, timeout=timeout, workers=workers, deadline=deadline,
+            cache=JsonFileCache(cache, ttl=cache_ttl) if cache else None,
+            history=HistoryStore(history) if history else None,
+            output=output, merge=merge, health=SensorHealth(health), hedge=hedge)
+        export_metrics(metrics_prom, metrics_json)
         sensor: str
         data: dict
         for sensor, data in measurements.items():
@@ -412,16 +2079,89 @@ def main(
             value: str
             for name, value in data.items():
                 print(f' {name:>12s}{value:>8s}')
-    else:
-        global MASTODON_HOST
-        global MASTODON_TOKEN
-        MASTODON_HOST = os.environ['SERVER']
-        MASTODON_TOKEN = os.environ['TOKEN']
-        measurements = pull_measurements(retries=retries, timeout=timeout)
-        push_aqi_status(measurements, former_bad_aqi=former_aqi,
-            retries=retries, timeout=timeout)
+        return os.EX_OK
+
+    def alerts(self,
+        state: OPT_STATE=STATE_DEFAULT,
+        ):
+        "Report the alert state and last values of every region"
+        store = open_state_store(state)
+        for region, alert in store.alerts().items():
+            updated: str = time.strftime('%Y-%m-%d %H:%M', time.localtime(alert['updated']))
+            pm25: str = '' if alert['pm25'] is None else f', PM2.5 {alert["pm25"]:.1f}'
+            print(f'{region}: {alert["aqi"]}{" (alert)" if alert["bad"] else ""}{pm25}, updated {updated}')
+            for sensor, data in store.last_values(region).items():
+                print(f' {sensor}')
+                for name, value in data.items():
+                    print(f' {name:>12s}{value:>8.1f}')
+        return os.EX_OK
+
+    def averages(self,
+        history: ("Measurement history file.", "positional"),
+        window: ("Averages report window, in hours.", "option", 'W', float)=24.,
+        ):
+        "Report average values from the measurement history"
+        for sensor, data in HistoryStore(history).averages(since=time.time() - window * 3600).items():
+            print(f'{sensor}')
+            for name, value in data.items():
+                print(f' {name:>12s}{value:>8.1f}')
+        return os.EX_OK
+
+    def backfill(self,
+        source: ("Directory or tar archive (optionally compressed) of captured widget pages.", "positional"),
+        output: ("File to write decoded measurements to, - for standard output.", "option", 'o')='-',
+        fmt: ("Output format.", "option", 'f', str, ['csv', 'jsonl'])='csv',
+        workers: ("Number of decoding processes.", "option", 'w', int)=os.cpu_count() or 1,
+        batch: ("Number of pages handed to a process at once.", "option", 'b', int)=64,
+        history: ("Measurement history file to append decoded captures to, "
+            "pages are filed under their directory name.", "option", 'H')=None,
+        ):
+        "Decode archived widget pages offline"
+        records = backfill_captures(source, workers=max(1, workers), batch_size=max(1, batch))
+        store: Union[HistoryStore, None] = HistoryStore(history) if history else None
+        if output == '-':
+            ndecoded, nfailed = write_backfill(records, sys.stdout, fmt, history=store)
+        else:
+            with open(output, 'wt', encoding='utf-8', newline='') as ofile:
+                ndecoded, nfailed = write_backfill(records, ofile, fmt, history=store)
+        logging.info(f'Decoded {ndecoded} captures, {nfailed} without measurements.')
+        return os.EX_OK
+
+    def test_chars(self):
+        "Test character recognition"
+        test_character_recognition()
+        return os.EX_OK
+
+    def test_nums(self):
+        "Test number recognition"
+        test_number_recognition()
+        return os.EX_OK
+
+    def test_history(self):
+        "Test the history store"
+        test_history_store()
+        return os.EX_OK
+
+    def test_state(self):
+        "Test the alert state stores"
+        test_state_store()
+        return os.EX_OK
+
+    def test_fan_out(self):
+        "Test scheduling of alert deliveries"
+        test_fan_out()
+        return os.EX_OK
+
+    def test_startup(self,
+        budget: ("Import time budget, in seconds.", "option", 'b', float)=IMPORT_BUDGET,
+        ):
+        "Test that importing the script stays within its time budget"
+        test_import_budget(budget)
+        return os.EX_OK
 
-    return os.EX_OK
 
 if __name__ == '__main__':
-    sys.exit(plac.call(main))
+    import plac
+
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(plac.call(Commands()))